@@ -8,19 +8,20 @@ import os
 import sys
 import logging
 
+import vcfio
 from hgmd import HGMD
 from omim import MIM
 from orpha import Orphanet
 from argparse import ArgumentParser
 
 def get_last_line(path):
-    with open(path) as file:
+    with vcfio.open_vcf(path) as file:
         for line in file:
             s = line
     return [s]
 
 def get_last_recessive(path):
-    with open(path) as file:
+    with vcfio.open_vcf(path) as file:
         cont = list(file)
         info = cont[-1].split('\t')
         if info[-1].strip() == '1/1' or info[-1].strip() == '1|1':
@@ -28,6 +29,11 @@ def get_last_recessive(path):
         else:
             return cont[-2:]
 
+def get_inserted(path):
+    """Return the inserted variant lines of a sorted (.vcf.gz) patient,
+    read from its sidecar, so they need not be at the end of the file"""
+    return vcfio.read_inserted(path)
+
 def get_actual_lines(path):
     with open(path) as file:    
         return filter(lambda x: not x.startswith('#'), list(file))
@@ -46,10 +52,19 @@ def is_match(linevs, linee):
             return True
     return False
 
-def get_by_variant(v, hgmd, lookup):
-    id = next(x for x in hgmd.entries if x.chrom == v[0].split('\t')[0] and x.loc == v[0].split('\t')[1]).omimid    
-    pheno_id = next(x for x in lookup.itervalues() if x.geno[0] == id).pheno[0]
-    return id, pheno_id
+def get_by_variant(v, hgmd, lookup, by_geno):
+    """Return (Orphanet #, genotypic OMIM, phenotypic OMIM) of the disease of an
+    inserted variant, raising KeyError if it is not in hgmd or lookup
+
+    by_geno is Orphanet.get_by_geno(lookup)
+    """
+    chrom, pos, _, ref, alt = v[0].split('\t')[:5]
+    entries = hgmd.get_by_variant(chrom, int(pos), ref, alt)
+    if not entries:
+        raise KeyError("No HGMD variant at %s:%s" % (chrom, pos))
+    id = entries[0].omimid
+    orphanum = by_geno[id][0]
+    return orphanum, id, lookup[orphanum].pheno[0]
 
 def get_by_name(vcf, lookup):
     orphanum = vcf.split('_')[-2]
@@ -65,16 +80,19 @@ def script(path, R):
     omim = filter(lambda x:x.db == 'OMIM', omim.diseases)
     omim_dict = {dis.id:dis for dis in omim}
     lookup = orph.filter_lookup(orph.lookup,omim_dict,rev_hgmd)
+    by_geno = orph.get_by_geno(lookup)
     contents = os.listdir(path)
-    vcf_files = filter(lambda f: f.endswith('.vcf'), contents)
+    vcf_files = filter(vcfio.is_vcf, contents)
     ezr_files = filter(lambda f: f.endswith('.ezr'), contents)
     if len(vcf_files) > len(ezr_files):
-        vcf_files = filter(lambda f: ''.join([f[:-4], '.ezr']) in ezr_files, vcf_files)
+        vcf_files = filter(lambda f: ''.join([vcfio.strip_vcf_ext(f), '.ezr']) in ezr_files, vcf_files)
     vcf_files.sort()
     ezr_files.sort()
 
     for vcf, ezr in zip(vcf_files, ezr_files):
-        if R:
+        if os.path.exists(os.path.join(path, vcf + vcfio.INSERTED_EXT)):
+            v = get_inserted(os.path.join(path, vcf))
+        elif R:
             v = get_last_recessive(os.path.join(path, vcf))
         else:
             v = get_last_line(os.path.join(path,vcf))
@@ -83,16 +101,16 @@ def script(path, R):
         rank = get_rank(v, elines)
         try:
             orph, id, pheno_id = get_by_name(vcf, lookup) 
-        except IndexError, KeyError:
-            #try:
-            #    id, pheno_id = get_by_variant(v, hgmd, lookup)
-            #except StopIteration:
-            #    logging.error("Couldn't find associated variant %s" % v[0])
-            #    logging.error("File %s" % vcf)
-            #    continue
-            logging.error("Name not found or incorrectly formatted %s" % vcf)
+        except (IndexError, KeyError):
+            logging.warning("Name not found or incorrectly formatted %s" % vcf)
+            try:
+                orph, id, pheno_id = get_by_variant(v, hgmd, lookup, by_geno)
+            except KeyError:
+                logging.error("Couldn't find associated variant %s" % v[0])
+                logging.error("File %s" % vcf)
+                continue
         
-        with open(os.path.join(path, vcf[:-4] + '.txt'), 'w') as file:
+        with open(os.path.join(path, vcfio.strip_vcf_ext(vcf) + '.txt'), 'w') as file:
             file.write('Rank of inserted variant: ' + str(rank) + '\n')
             file.write('Variant: ' + str(v[0]).strip() + '\n')
             if len(v) > 1:
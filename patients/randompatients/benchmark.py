@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the hot paths of patient generation. Each subcommand
+times the current implementation (and the approach it replaced, where
+that is still meaningful) and prints one line per measurement.
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import random
+import logging
+import resource
+import tempfile
+import multiprocessing
+
+import hpo
+import hgmd
+import orpha
+import generate_patient_pairs as gp
+
+from argparse import ArgumentParser
+from orpha import Disease
+from omim import Disease as OmimDisease, PhenotypeMatrix
+
+
+__author__ = 'Tal Friedman (talf301@gmail.com)'
+
+def timed(func, *args):
+    """Return (seconds, result) of calling func(*args)"""
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def report(name, size, seconds, num=None):
+    """Print one benchmark measurement, with per-item cost if num given"""
+    line = '%-30s %10s %10.4fs' % (name, size, seconds)
+    if num:
+        line += ' %10.3fus/item' % (seconds / num * 1e6)
+    print(line)
+
+def report_memory(name, size, kilobytes, num=None):
+    """Print one memory measurement, with per-item cost if num given"""
+    line = '%-30s %10s %10.1fMB' % (name, size, kilobytes / 1024.0)
+    if num:
+        line += ' %10.0fB/item' % (kilobytes * 1024.0 / num)
+    print(line)
+
+def _rss_increase(func, args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(*args)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def in_fresh_process(func, *args):
+    """Return func(*args), called in a new process"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.terminate()
+
+def rss_increase(func, *args):
+    """Return the increase in peak RSS (KB) of calling func(*args) in a fresh process"""
+    return in_fresh_process(_rss_increase, func, args)
+
+def fake_lookup(num_diseases, max_variants=50):
+    """Return (lookup, rev_hgmd) with num_diseases random AD diseases"""
+    lookup = {}
+    rev_hgmd = {}
+    for k in range(num_diseases):
+        dis = Disease()
+        dis.pheno.append(str(100000 + k))
+        dis.geno.append(str(600000 + k))
+        dis.inheritance.append('Autosomal dominant')
+        lookup[str(k + 1)] = dis
+        rev_hgmd[dis.geno[0]] = [None] * random.randint(1, max_variants)
+    return lookup, rev_hgmd
+
+def bench_sampler(num_diseases, sizes, **kwargs):
+    """Time drawing diseases by variant: per-draw list rebuild vs DiseaseSampler"""
+    lookup, rev_hgmd = fake_lookup(num_diseases)
+
+    def old_draws(num):
+        for i in range(num):
+            gp.weighted_choice(lookup.keys(),
+                    [len(rev_hgmd[x.geno[0]]) for x in lookup.itervalues()])
+
+    def new_draws(num):
+        sampler = gp.DiseaseSampler(lookup, rev_hgmd, by_variant=True)
+        sampler.sample_many(num)
+
+    for num in sizes:
+        # The old approach is quadratic overall, so keep it to small runs
+        if num <= 10000:
+            seconds, _ = timed(old_draws, num)
+            report('weighted_choice', num, seconds, num)
+        seconds, _ = timed(new_draws, num)
+        report('DiseaseSampler', num, seconds, num)
+
+def bench_workers(data_path, vcf_path, num_samples, workers, seed, **kwargs):
+    """Time generating the same pairs with different numbers of workers,
+    reporting throughput in samples per second"""
+    if not workers:
+        workers = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+
+    def run(num, num_workers):
+        out_path = tempfile.mkdtemp()
+        try:
+            gp.script(data_path, vcf_path, out_path, 'PAIRS', num, by_variant=False,
+                    default_freq=1.0, drop_intronic=False, imprecision=True, noise=0.5,
+                    inheritance=['AD', 'AR'], seed=seed, workers=num_workers)
+        finally:
+            shutil.rmtree(out_path)
+
+    # Loading the data is a fixed cost of every run, so time it separately
+    load_seconds, _ = timed(run, 0, 1)
+    report('load (no samples)', 0, load_seconds)
+    for num_workers in workers:
+        seconds, _ = timed(run, num_samples, num_workers)
+        report('script (%d workers)' % num_workers, num_samples, seconds, num_samples)
+        print('%-30s %10s %10.1f' % ('samples/s', num_samples, num_samples / seconds))
+        print('%-30s %10s %10.1f' % ('samples/s, excluding load', num_samples,
+                num_samples / max(seconds - load_seconds, 1e-9)))
+
+class LegacyHP(object):
+    """HPO graph node, frozen as it was before OboTable, linked by sets"""
+    def __init__(self, lines):
+        self.parents = set()
+        self.children = set()
+        self.alts = set()
+        self._parent_hps = set()
+
+        for line in lines:
+            field, value = line.split(': ', 1)
+            if field == 'is_obsolete':
+                raise hpo.HPObsoleteError()
+            elif field == 'id':
+                self.id = value
+            elif field == 'name':
+                self.name = value
+            elif field == 'alt_id':
+                self.alts.add(value)
+            elif field == 'is_a':
+                self._parent_hps.add(value.split('!')[0].strip())
+
+    def link(self, hps):
+        for hp in self._parent_hps:
+            parent = hps[hp]
+            self.parents.add(parent)
+            parent.children.add(self)
+
+    def is_root(self):
+        return len(self._parent_hps) == 0
+
+def _iter_hp_terms(reader):
+    term_lines = None
+    for line in reader:
+        line = line.strip()
+        if not line: continue
+        if line == '[Term]':
+            if term_lines:
+                yield term_lines
+            term_lines = []
+        elif term_lines is not None:
+            term_lines.append(line)
+    if term_lines:
+        yield term_lines
+
+class LegacyHPO(object):
+    """HPO graph, frozen as it was before OboTable: {hp -> LegacyHP} linked by sets"""
+    def __init__(self, filename):
+        self.hps = {}
+        self.root = None
+        roots = []
+        with open(filename) as ifp:
+            self.version = ifp.readline().strip().split(': ')[1]
+            for lines in _iter_hp_terms(ifp):
+                try:
+                    hp = LegacyHP(lines)
+                except hpo.HPError:
+                    continue
+                if hp.is_root():
+                    roots.append(hp)
+                self.hps[hp.id] = hp
+                for hpid in hp.alts:
+                    self.hps[hpid] = hp
+
+        for node in set(self.hps.values()):
+            node.link(self.hps)
+        if len(roots) == 1:
+            self.root = roots[0]
+
+def bench_obo(hpo_filename, repeat, **kwargs):
+    """Time loading an OBO file: the dict-linked HPO it replaced vs OboTable and HPO"""
+    num = len(hpo.OboTable(hpo_filename))
+    for name, func in [('dict-linked HPO (baseline)', LegacyHPO),
+                       ('OboTable', hpo.OboTable),
+                       ('HPO', hpo.HPO)]:
+        seconds = min(timed(func, hpo_filename)[0] for i in range(repeat))
+        report(name, num, seconds, num)
+
+def bench_hpo_memory(hpo_filename, **kwargs):
+    """Measure the memory of a loaded HPO against the dict-linked HPO it replaced"""
+    num = len(hpo.OboTable(hpo_filename))
+    for name, func in [('dict-linked HPO (baseline)', LegacyHPO),
+                       ('OboTable', hpo.OboTable),
+                       ('HPO', hpo.HPO)]:
+        report_memory(name, num, rss_increase(func, hpo_filename), num)
+
+def fake_cohort(hp, num_patients, min_terms=5, max_terms=15):
+    """Return a list of num_patients random lists of HP terms"""
+    return [random.sample(hp.term_ids, random.randint(min_terms, max_terms))
+            for i in range(num_patients)]
+
+def _time_similarity(hpo_filename, num_patients, top, block_size):
+    import similarity
+    hp = hpo.HPO(hpo_filename)
+    random.seed(num_patients)
+    phenotypes = fake_cohort(hp, num_patients)
+    ic = hpo.InformationContent(hp, phenotypes)
+
+    def score():
+        matrix = similarity.patient_matrix(hp, phenotypes)
+        for i, matches in similarity.top_matches(matrix, ic.ic, top, block_size=block_size):
+            pass
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, _ = timed(score)
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def bench_similarity(hpo_filename, sizes, top, block_size, **kwargs):
+    """Time and measure all-pairs top-k scoring of random cohorts"""
+    for num in sizes:
+        seconds, kilobytes = in_fresh_process(_time_similarity, hpo_filename, num, top, block_size)
+        report('top_matches', num, seconds, num)
+        report_memory('top_matches', num, kilobytes, num)
+
+def bench_lsh(hpo_filename, num_patients, top, bands, num_hashes, recall_sample, **kwargs):
+    """Time exact vs MinHash LSH top-k scoring of a random cohort, with recall"""
+    import similarity
+    hp = hpo.HPO(hpo_filename)
+    random.seed(num_patients)
+    phenotypes = fake_cohort(hp, num_patients)
+    ic = hpo.InformationContent(hp, phenotypes)
+    matrix = similarity.patient_matrix(hp, phenotypes)
+
+    seconds, _ = timed(lambda: list(similarity.top_matches(matrix, ic.ic, top)))
+    report('top_matches', num_patients, seconds, num_patients)
+    for num_bands in bands:
+        seconds, matches = timed(lambda: dict(similarity.candidate_matches(
+                matrix, ic.ic, top, num_hashes=num_hashes, bands=num_bands)))
+        fraction, num = similarity.recall(matrix, ic.ic, matches, top, sample=recall_sample)
+        report('candidate_matches (%d bands)' % num_bands, num_patients, seconds, num_patients)
+        print('%-30s %10s %10.4f' % ('recall', num, fraction))
+
+def sample_phenotypes_by_term(omim_dis, default_freq=1.0):
+    """Return one phenotype set drawn with a random() call per term, as
+    sample_phenotypes did before sample_phenotype_sets"""
+    while True:
+        phenotypes = []
+        for pheno, freq in omim_dis.phenotype_freqs.iteritems():
+            if not freq and random.random() < default_freq:
+                phenotypes.append(pheno)
+            else:
+                if random.random() < freq:
+                    phenotypes.append(pheno)
+        if phenotypes:
+            return phenotypes
+
+def fake_omim(num_diseases, min_terms=5, max_terms=30):
+    """Return a list of num_diseases omim.Disease with random phenotypes,
+    a third of them without a frequency"""
+    terms = ['HP:%07d' % k for k in range(10000)]
+    freqs = [None, 0.01, 0.05, 0.3, 0.5, 0.8, 0.99]
+    return [OmimDisease('OMIM', str(100000 + k), 'Disease %d' % k,
+                    dict((term, random.choice(freqs)) for term in
+                         random.sample(terms, random.randint(min_terms, max_terms))))
+            for k in range(num_diseases)]
+
+def bench_phenotypes(num_diseases, sizes, repeat, **kwargs):
+    """Time drawing phenotype sets per patient: a random() call per term vs
+    sample_phenotype_sets, from a matrix built per call or once per run"""
+    random.seed(num_diseases)
+    diseases = fake_omim(num_diseases)
+    matrix = gp.phenotype_matrix(dict((dis.id, dis) for dis in diseases))
+
+    def by_term(num):
+        for dis in diseases:
+            for i in range(num):
+                sample_phenotypes_by_term(dis)
+
+    def sets(num):
+        for dis in diseases:
+            gp.sample_phenotype_sets(PhenotypeMatrix([dis]), 0, num)
+
+    def matrix_sets(num):
+        for dis in diseases:
+            gp.sample_phenotype_sets(matrix, matrix.row_index[dis.db, dis.id], num)
+
+    for num in sizes:
+        num_patients = num * num_diseases
+        for name, func in [('random() per term (baseline)', by_term),
+                           ('sets, matrix per call', sets),
+                           ('sets, matrix per run', matrix_sets)]:
+            seconds = min(timed(func, num)[0] for i in range(repeat))
+            report('%s x%d' % (name, num), num_patients, seconds, num_patients)
+
+def load_orphanet_by_tree(lookup_filename, inher_filename, geno_pheno_filename):
+    """Parse the Orphanet files as whole trees, as Orphanet did before iter_disorders"""
+    import xml.etree.ElementTree as ET
+    for filename in [lookup_filename, inher_filename, geno_pheno_filename]:
+        root = ET.parse(filename).getroot()
+        for disorder in root.findall('.//Disorder'):
+            disorder.find('OrphaNumber').text
+
+def _time_and_rss(func, args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, _ = timed(func, *args)
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def bench_orphanet(data_path, **kwargs):
+    """Time and measure parsing the Orphanet XML files: whole trees vs iterparse"""
+    filenames = [os.path.join(data_path, filename) for filename in
+            ['orphanet_lookup.xml', 'orphanet_inher.xml', 'orphanet_geno_pheno.xml']]
+    num = sum(1 for filename in filenames for disorder in orpha.iter_disorders(filename))
+    for name, func in [('ElementTree.parse', load_orphanet_by_tree),
+                       ('Orphanet (iterparse)', orpha.Orphanet)]:
+        seconds, kilobytes = in_fresh_process(_time_and_rss, func, filenames)
+        report(name, num, seconds, num)
+        report_memory(name, num, kilobytes, num)
+
+class LineEntry:
+    """An HGMD variant as a plain object, as HGMD stored them before its columns"""
+    def __init__(self, chrom, loc, ref, alt, effect, pmid, omimid, info_line):
+        self.chrom = chrom
+        self.loc = loc
+        self.ref = ref
+        self.alt = alt
+        self.effect = effect
+        self.omimid = omimid
+        self.pmid = pmid
+        self.info_line = info_line
+
+def load_hgmd_entries(filename):
+    """Return (entries, rev_hgmd) parsed line by line, as HGMD did before its columns"""
+    entries = []
+    with open(filename) as ifp:
+        for line in ifp:
+            if line == '\n' or line[0] == '#': continue
+            info = line.rstrip().split('\t')
+            info_line = info[7]
+            effect = info_line.split(';')[0].split('=')[1]
+            omimid = info_line.split(';')[2].split(':')[1]
+            pmid = info_line.split(';')[3].split(':')[1]
+            entries.append(LineEntry(info[0], info[1], info[3], info[4], effect,
+                    pmid, omimid, info[7].strip()))
+    rev_hgmd = {}
+    for entry in filter(lambda x: x.omimid, entries):
+        rev_hgmd.setdefault(entry.omimid, []).append(entry)
+    return entries, rev_hgmd
+
+def load_hgmd(filename):
+    """Return (HGMD, rev_hgmd) of the given file"""
+    data = hgmd.HGMD(filename)
+    return data, data.get_by_omim()
+
+def load_hgmd_lazy(filename):
+    """Return (HGMD, rev_hgmd) of the given file, loaded lazily"""
+    data = hgmd.HGMD(filename, lazy=True)
+    return data, data.get_by_omim()
+
+def bench_hgmd(hgmd_filename, **kwargs):
+    """Time and measure loading an HGMD file: Entry per line vs columns vs lazy"""
+    num = len(hgmd.HGMD(hgmd_filename, lazy=True))
+    for name, func in [('Entry per line', load_hgmd_entries),
+                       ('HGMD (columns)', load_hgmd),
+                       ('HGMD (lazy)', load_hgmd_lazy)]:
+        seconds, kilobytes = in_fresh_process(_time_and_rss, func, [hgmd_filename])
+        report(name, num, seconds, num)
+        report_memory(name, num, kilobytes, num)
+
+def parse_args(args):
+    parser = ArgumentParser(description=__doc__.strip())
+    subparsers = parser.add_subparsers()
+
+    subparser = subparsers.add_parser('sampler', help=bench_sampler.__doc__)
+    subparser.add_argument('--num_diseases', type=int, default=3000,
+            help='Number of diseases in the fake lookup')
+    subparser.add_argument('--sizes', type=int, nargs='+',
+            default=[1000, 10000, 100000, 1000000],
+            help='Numbers of draws to time')
+    subparser.set_defaults(function=bench_sampler)
+
+    subparser = subparsers.add_parser('workers', help=bench_workers.__doc__)
+    subparser.add_argument('data_path', metavar='DATA',
+            help='Directory with the data files (and snapshot, if compiled)')
+    subparser.add_argument('--vcf_path',
+            help='Directory of control vcfs to copy (default is phenotypes only)')
+    subparser.add_argument('-N', type=int, dest='num_samples', default=2000,
+            help='Number of pairs to generate in each run')
+    subparser.add_argument('--workers', type=int, nargs='+',
+            help='Numbers of workers to time (default is 1, 2, 4 and the'
+            ' number of CPUs)')
+    subparser.add_argument('--seed', type=int, default=1,
+            help='Master seed of every run')
+    subparser.set_defaults(function=bench_workers)
+
+    subparser = subparsers.add_parser('phenotypes', help=bench_phenotypes.__doc__)
+    subparser.add_argument('--num_diseases', type=int, default=3000,
+            help='Number of fake OMIM diseases')
+    subparser.add_argument('--sizes', type=int, nargs='+', default=[1, 2, 1000],
+            help='Numbers of phenotype sets to draw per disease at a time'
+            ' (2 is the PAIRS path)')
+    subparser.add_argument('--repeat', type=int, default=3,
+            help='Number of runs to take the best time of')
+    subparser.set_defaults(function=bench_phenotypes)
+
+    subparser = subparsers.add_parser('obo', help=bench_obo.__doc__)
+    subparser.add_argument('hpo_filename', metavar='HPO',
+            help='OBO file to load, e.g. hp.obo')
+    subparser.add_argument('--repeat', type=int, default=3,
+            help='Number of loads to take the best time of')
+    subparser.set_defaults(function=bench_obo)
+
+    subparser = subparsers.add_parser('hpo_memory', help=bench_hpo_memory.__doc__)
+    subparser.add_argument('hpo_filename', metavar='HPO',
+            help='OBO file to load, e.g. hp.obo')
+    subparser.set_defaults(function=bench_hpo_memory)
+
+    subparser = subparsers.add_parser('similarity', help=bench_similarity.__doc__)
+    subparser.add_argument('hpo_filename', metavar='HPO',
+            help='OBO file to load, e.g. hp.obo')
+    subparser.add_argument('--sizes', type=int, nargs='+',
+            default=[1000, 2000, 5000, 10000],
+            help='Numbers of patients to score')
+    subparser.add_argument('--top', type=int, default=10,
+            help='Number of matches to keep per patient')
+    subparser.add_argument('--block_size', type=int, default=256,
+            help='Number of patients to score at a time')
+    subparser.set_defaults(function=bench_similarity)
+
+    subparser = subparsers.add_parser('lsh', help=bench_lsh.__doc__)
+    subparser.add_argument('hpo_filename', metavar='HPO',
+            help='OBO file to load, e.g. hp.obo')
+    subparser.add_argument('--num_patients', type=int, default=5000,
+            help='Number of patients in the cohort')
+    subparser.add_argument('--top', type=int, default=10,
+            help='Number of matches to keep per patient')
+    subparser.add_argument('--bands', type=int, nargs='+', default=[8, 16, 32],
+            help='Numbers of LSH bands to time')
+    subparser.add_argument('--num_hashes', type=int, default=64,
+            help='Number of MinHash hashes per patient')
+    subparser.add_argument('--recall_sample', type=int, default=500,
+            help='Number of patients to measure recall on')
+    subparser.set_defaults(function=bench_lsh)
+
+    subparser = subparsers.add_parser('orphanet', help=bench_orphanet.__doc__)
+    subparser.add_argument('data_path', metavar='DATA',
+            help='Directory with the Orphanet XML files')
+    subparser.set_defaults(function=bench_orphanet)
+
+    subparser = subparsers.add_parser('hgmd', help=bench_hgmd.__doc__)
+    subparser.add_argument('hgmd_filename', metavar='HGMD',
+            help='HGMD file to load, e.g. hgmd_correct.jv.vcf')
+    subparser.set_defaults(function=bench_hgmd)
+
+    parser.add_argument('--logging', default='WARNING',
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            help='Logging level')
+    return parser.parse_args(args)
+
+def main(args = sys.argv[1:]):
+    args = parse_args(args)
+    logging.basicConfig(level=args.logging)
+    args.function(**vars(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Materialize delta patient files into full VCFs. A delta file stores a
+generated patient as a reference to the control VCF it was made from, plus
+the variants inserted into it and its sampled phenotypes, so the full VCF
+(the control followed by the inserted variants) is only written when needed.
+"""
+
+
+import os
+import sys
+import shutil
+import logging
+
+import vcfio
+from argparse import ArgumentParser
+
+
+__author__ = 'Tal Friedman (talf301@gmail.com)'
+
+SOURCE_PREFIX = '##source='
+HPO_PREFIX = '##hpo='
+DELTA_EXT = '.delta'
+
+class Delta:
+    """A generated patient stored relative to its control VCF
+
+    Attributes:
+    source: path to the control VCF (.vcf or .vcf.gz)
+    phenotypes: list of HPO terms
+    lines: list of newline-terminated VCF lines inserted into the control
+    """
+    def __init__(self, source, phenotypes, lines):
+        self.source = source
+        self.phenotypes = phenotypes
+        self.lines = lines
+
+    @classmethod
+    def read(cls, filename):
+        """Return the Delta stored in the given file"""
+        source = None
+        phenotypes = []
+        lines = []
+        with open(filename) as ifp:
+            for line in ifp:
+                if line.startswith(SOURCE_PREFIX):
+                    source = line[len(SOURCE_PREFIX):].rstrip('\n')
+                elif line.startswith(HPO_PREFIX):
+                    hpo = line[len(HPO_PREFIX):].rstrip('\n')
+                    phenotypes = hpo.split(',') if hpo else []
+                elif line.strip():
+                    lines.append(line)
+        assert source, "Missing source VCF in delta file: %s" % filename
+        return cls(source, phenotypes, lines)
+
+    def write(self, filename):
+        """Write this Delta to the given file"""
+        with open(filename, 'w') as ofp:
+            ofp.write(SOURCE_PREFIX + self.source + '\n')
+            ofp.write(HPO_PREFIX + ','.join(self.phenotypes) + '\n')
+            for line in self.lines:
+                ofp.write(line)
+
+    def materialize(self, ofp):
+        """Write the full (uncompressed) VCF for this patient to the given file object"""
+        with vcfio.open_vcf(self.source) as ifp:
+            shutil.copyfileobj(ifp, ofp)
+        for line in self.lines:
+            ofp.write(line)
+
+def materialized_filename(filename):
+    """Return the VCF filename for a delta file (HG01_1_2.vcf.delta -> HG01_1_2.vcf)"""
+    if filename.endswith(DELTA_EXT):
+        return filename[:-len(DELTA_EXT)]
+    return filename + '.vcf'
+
+def script(delta_files, out_path=None, **kwargs):
+    if out_path is None:
+        # Stream to stdout, e.g. to pipe into another program
+        for filename in delta_files:
+            Delta.read(filename).materialize(sys.stdout)
+        return
+
+    for filename in delta_files:
+        out_filename = os.path.join(out_path, materialized_filename(os.path.basename(filename)))
+        logging.info("Materializing %s -> %s" % (filename, out_filename))
+        with open(out_filename, 'w') as ofp:
+            Delta.read(filename).materialize(ofp)
+
+def parse_args(args):
+    parser = ArgumentParser(description=__doc__.strip())
+
+    parser.add_argument('delta_files', metavar='DELTA', nargs='+',
+            help='Delta patient files to materialize')
+    parser.add_argument('--out_path', '-o', metavar='OUT',
+            help='Directory to write full VCFs to (default is to write'
+            ' them all to stdout)')
+    parser.add_argument('--logging', default='WARNING',
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            help='Logging level')
+    return parser.parse_args(args)
+
+def main(args = sys.argv[1:]):
+    args = parse_args(args)
+    logging.basicConfig(level=args.logging)
+    script(**vars(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,38 +13,99 @@ have the same variants added or the exact same phenotypes.
 
 import os
 import sys
+import time
 import shutil
 import logging
 import random
+import bisect
+import hashlib
+import traceback
+import multiprocessing
+
+import numpy
 
 import hpo
+import orpha
+import vcfio
+import snapshot
 
 from collections import defaultdict
 from argparse import ArgumentParser
 from orpha import Orphanet
-from hgmd import HGMD
-from omim import MIM
+from hgmd import HGMD, CODING_EFFECTS, NONCODING_EFFECTS
+from omim import MIM, PhenotypeMatrix
+from delta import Delta
+from manifest import Manifest, ManifestError
 
 
 __author__ = 'Tal Friedman (talf301@gmail.com)'
 
-def add_noise(num, phenotypes, omim_dict):
+class NoisePool(object):
+    """Pool of phenotypes to draw noise from, read from the phenotype matrix
+
+    Every phenotype annotation of every OMIM disease contributes one
+    entry, so terms are drawn in proportion to how often diseases are
+    annotated with them.
+
+    Attributes:
+    terms: list of distinct phenotypes (the columns of the matrix)
+    term_index: {phenotype -> index into terms}
+    pool: array of indices into terms, one per annotation
+    distinct: whether to only draw phenotypes the patient does not have
+    """
+    def __init__(self, matrix, distinct=False):
+        """Build the pool from an omim.PhenotypeMatrix (see phenotype_matrix)"""
+        self.terms = matrix.terms
+        self.term_index = matrix.term_index
+        self.pool = matrix.indices
+        self.distinct = distinct
+
+    def __len__(self):
+        return len(self.pool)
+
+    def sample(self, num, exclude=None):
+        """Return a list of num random phenotypes from the pool
+
+        Args:
+            num: number of phenotypes to draw
+            exclude: collection of phenotypes not to draw, in which case
+                the drawn phenotypes are also distinct from one another
+                (and fewer than num are returned if the pool runs out)
+
+        Returns:
+            A list of phenotypes
+        """
+        if exclude is None:
+            # Sampling without replacement from an array is O(num)
+            return [self.terms[k] for k in random.sample(self.pool, num)]
+
+        exclude = set(exclude)
+        num = min(num, len(self.terms) - sum(1 for x in exclude if x in self.term_index))
+        sampled = []
+        while len(sampled) < num:
+            pheno = self.terms[self.pool[random.randrange(len(self.pool))]]
+            if pheno not in exclude:
+                exclude.add(pheno)
+                sampled.append(pheno)
+        return sampled
+
+def add_noise(num, phenotypes, noise_pool):
     """Randomly add terms to the given list of phenotpes
     from our omim diseases
     
     Args:
         num: number of random phenotypes to add
         phenotypes: list of phenotypes to add noise to
-        omim_dct: a dict of OMIM number -> omim.Disease
+        noise_pool: a NoisePool instance
 
     Returns:
         A list of the phenotypes with noise added.
     """
-    # List of phenotypes to sample from
-    sample_list = [x for y in omim_dict.itervalues() for x in y.phenotype_freqs]
-
     # Do sampling
-    sampled_pheno = random.sample(sample_list, num)
+    if noise_pool.distinct:
+        sampled_pheno = noise_pool.sample(num, exclude=phenotypes)
+    else:
+        sampled_pheno = noise_pool.sample(num)
     # Finally combine them and remove repetition
     phenotypes.extend(sampled_pheno)
     phenotypes = list(set(phenotypes))
@@ -69,39 +130,83 @@ def add_imprecision(hp, phenotypes):
     
     for pheno in phenotypes:
         try:
-            # Key may not be found since there are things like
-            # Inheritance patterns in phenotypic annotations
-            ancestors = list(hpo.get_ancestors(hp[pheno]))
+            # Randomly add an ancestor (other than the root). Key may not
+            # be found since there are things like inheritance patterns
+            # in phenotypic annotations
+            new_pheno.add(hp.random_ancestor(pheno))
         except KeyError:
             continue
 
-        # Get as string ids and remove root
-        ancestors = map(lambda x: x.id, ancestors)
-        ancestors.remove('HP:0000118')
-
-        # Now randomly add an ancestor
-        new_pheno.add(random.choice(ancestors))
-
     # Return phenotypes as a list
     return list(new_pheno)
 
-def sample_phenotypes(omim_dict, orph_disease, hp, imprecision, noise, default_freq=1.0):
-    """Sample phenotypes randomly from an orphanet disease
+def phenotype_matrix(omim_dict):
+    """Return the omim.PhenotypeMatrix of the diseases in omim_dict, with
+    rows in order of OMIM number"""
+    return PhenotypeMatrix([omim_dict[omim_id] for omim_id in sorted(omim_dict)])
+
+def sample_phenotype_sets(matrix, row, num, default_freq=1.0):
+    """Sample num phenotype sets at once from a disease of the phenotype matrix
+
+    Every annotated phenotype is kept with its frequency (or default_freq
+    if not specified), drawn as a single num x phenotypes Bernoulli matrix.
+    Rows which come out empty are redrawn together until none remain.
+
+    Args:
+        matrix: an omim.PhenotypeMatrix
+        row: row of the disease in matrix, which has at least one phenotype
+        num: number of phenotype sets to sample
+        default_freq: default frequency to use if not specified
+
+    Returns:
+        A list of num non-empty lists of sampled phenotypes
+    """
+    start = matrix.indptr[row]
+    end = matrix.indptr[row + 1]
+    db, omim_id = matrix.keys[row]
+    assert end > start, "Missing phenotypes for: %s" % omim_id
+    terms = matrix.entry_terms[start:end]
+    freqs = matrix.probabilities(default_freq)[start:end]
+
+    chosen = numpy.random.random_sample((num, len(terms))) < freqs
+    phenotype_sets = [terms[drawn].tolist() for drawn in chosen]
+    empty = [k for k, phenotypes in enumerate(phenotype_sets) if not phenotypes]
+    num_redrawn = 0
+    while empty:
+        assert freqs.any(), "Zero frequency for all phenotypes of: %s" % omim_id
+        num_redrawn += len(empty)
+        chosen = numpy.random.random_sample((len(empty), len(terms))) < freqs
+        for k, drawn in zip(empty, chosen):
+            phenotype_sets[k] = terms[drawn].tolist()
+        empty = [k for k in empty if not phenotype_sets[k]]
+    if num_redrawn:
+        logging.warning("Random phenotype sampling for %s resulted in"
+                " %d empty sets" % (omim_id, num_redrawn))
+
+    return phenotype_sets
+
+def sample_many_phenotypes(omim_dict, orph_disease, num, hp, imprecision, noise,
+        default_freq=1.0, noise_pool=None, matrix=None):
+    """Sample num phenotype sets randomly from an orphanet disease
 
     Args:
         omim: a dict of OMIM number -> omim.Disease
         orph_disease: an orpha.Disease
+        num: number of phenotype sets to sample
         hp: an hpo.HPO instance 
         imprecision: whether or not to add imprecision
+        noise: fraction of the sampled phenotypes to add as noise
         default_freq: default frequency to use if not specified
+        noise_pool: a NoisePool to draw noise from (built from omim_dict
+            if not given)
+        matrix: the phenotype matrix of omim_dict (see phenotype_matrix),
+            built for just this disease if not given
 
     Each disease should have at least one phenotype entry
 
     Returns:
-        A list of sampled phenotypes
+        A list of num lists of sampled phenotypes
     """
-    phenotypes = []
-
     # Lookup phenotypic OMIM for orphanet disease
     omim_id = orph_disease.pheno[0]
 
@@ -110,17 +215,17 @@ def sample_phenotypes(omim_dict, orph_disease, hp, imprecision, noise, default_f
         omim_dis = omim_dict[omim_id]
     except KeyError:
         logging.warning('Could not find OMIM entry for %s' % omim_id)
+        raise
 
     # If frequency available, we will sample, otherwise use default freq 
-    phenotype_freqs = omim_dis.phenotype_freqs
-    assert phenotype_freqs, "Missing phenotypes for: %s" % omim_id
-    for pheno, freq in phenotype_freqs.iteritems():
-        if not freq and random.random() < default_freq:
-            phenotypes.append(pheno)
-        else:
-            if random.random() < freq:
-                phenotypes.append(pheno)
-    if phenotypes:
+    if matrix is None:
+        matrix = PhenotypeMatrix([omim_dis])
+    phenotype_sets = sample_phenotype_sets(matrix, matrix.row_index[omim_dis.db, omim_dis.id],
+            num, default_freq)
+
+    if noise and noise_pool is None:
+        noise_pool = NoisePool(phenotype_matrix(omim_dict))
+    for k, phenotypes in enumerate(phenotype_sets):
         # Log the original number of phenotypes
         orig_len = len(phenotypes)
         # Add imprecision if necessary
@@ -128,12 +233,22 @@ def sample_phenotypes(omim_dict, orph_disease, hp, imprecision, noise, default_f
             phenotypes = add_imprecision(hp, phenotypes) 
         # Add noise if necessary
         if noise:
-            phenotypes = add_noise(int(orig_len * noise), phenotypes, omim_dict)
-        return phenotypes
-    else:
-        logging.warning("Random phenotype sampling for %s resulted in"
-                " empty set" % omim_id)
-        return sample_phenotypes(omim_dict, orph_disease, hp, imprecision, noise, default_freq)
+            phenotypes = add_noise(int(orig_len * noise), phenotypes, noise_pool)
+        phenotype_sets[k] = phenotypes
+
+    return phenotype_sets
+
+def sample_phenotypes(omim_dict, orph_disease, hp, imprecision, noise, default_freq=1.0,
+        noise_pool=None, matrix=None):
+    """Sample phenotypes randomly from an orphanet disease
+
+    Args are as for sample_many_phenotypes.
+
+    Returns:
+        A list of sampled phenotypes
+    """
+    return sample_many_phenotypes(omim_dict, orph_disease, 1, hp, imprecision, noise,
+            default_freq, noise_pool, matrix)[0]
 
 def sample_variants(rev_hgmd, orph_disease):
     """Sample variants randomly from an orphanet disease
@@ -174,7 +289,8 @@ def generate_vcf_line(var, hom=False):
     return '%s\n' % '\t'.join([var.chrom, var.loc, '.', var.ref, 
         var.alt, '255', 'PASS', var.info_line, 'GT', gt])
 
-def infect_pheno(patient, orph_disease, omim_dict, hp, imprecision, noise, default_freq):
+def infect_pheno(patient, orph_disease, omim_dict, hp, imprecision, noise, default_freq,
+        noise_pool=None, phenotypes=None):
     """Do phenotypic infection by producing a file with a
     list of phenotypes associated with disease
 
@@ -184,16 +300,20 @@ def infect_pheno(patient, orph_disease, omim_dict, hp, imprecision, noise, defau
         omim_dict: a dict of OMIM number -> omim.Disease
         hp: an hpo.HPO instance
         imprecision: whether or not to add imprecision to pheno sampling
+        noise: fraction of the sampled phenotypes to add as noise
         default_freq: default frequency to use if info not found
+        noise_pool: a NoisePool to draw noise from
+        phenotypes: list of already sampled phenotypes to use, if given
     """
     # Sample phenotypes
-    phenotypes = sample_phenotypes(omim_dict, orph_disease, hp,
-            imprecision, noise, default_freq)
+    if phenotypes is None:
+        phenotypes = sample_phenotypes(omim_dict, orph_disease, hp,
+                imprecision, noise, default_freq, noise_pool)
 
-    assert patient.endswith('.vcf')
+    assert vcfio.is_vcf(patient)
 
-    # If patient is HG01.vcf, phenotypes in HG01_hpo.txt
-    pheno_file = patient[:-4] + '_hpo.txt'
+    # If patient is HG01.vcf (or HG01.vcf.gz), phenotypes in HG01_hpo.txt
+    pheno_file = vcfio.strip_vcf_ext(patient) + '_hpo.txt'
     with open(pheno_file, 'w') as hpo:
         hpo.write(','.join(phenotypes))
 
@@ -202,18 +322,57 @@ def infect_geno(patient, orph_disease, rev_hgmd):
     associated with disease.
 
     Args:
-        patient: a string path to the patient vcf
+        patient: a string path to the patient vcf (.vcf or .vcf.gz,
+            which is appended to without recompressing)
+        orph_disease: an orpha.Disease instance to infect patient with
+        rev_hgmd: a dict of OMIM number -> list(hgmd.Entry)
+    """
+    # Sample variants
+    variants = sample_variants(rev_hgmd, orph_disease)
+
+    assert vcfio.is_vcf(patient)
+
+    vcfio.append_vcf(patient, [generate_vcf_line(variant, hom=hom) for variant, hom in variants])
+
+def infect_delta(patient, source, orph_disease, rev_hgmd, phenotypes):
+    """Do genotypic infection without copying the control vcf, by writing
+    a delta file (see delta.py) referring to it instead.
+
+    Args:
+        patient: a string path to the patient vcf, which the delta file
+            is named after (HG01.vcf -> HG01.vcf.delta)
+        source: a string path to the control vcf
         orph_disease: an orpha.Disease instance to infect patient with
         rev_hgmd: a dict of OMIM number -> list(hgmd.Entry)
+        phenotypes: list of phenotypes of the patient
     """
     # Sample variants
     variants = sample_variants(rev_hgmd, orph_disease)
 
     assert patient.endswith('.vcf')
 
-    with open(patient, 'a') as vcf:
-        for variant, hom in variants:
-            vcf.write(generate_vcf_line(variant, hom=hom))
+    lines = [generate_vcf_line(variant, hom=hom) for variant, hom in variants]
+    Delta(os.path.abspath(source), phenotypes, lines).write(patient + '.delta')
+
+def infect_sorted(patient, source, orph_disease, rev_hgmd):
+    """Do genotypic infection by merging harmful variants associated with
+    disease into the control vcf in coordinate order, writing BGZF.
+
+    Args:
+        patient: a string path to the patient vcf, which the output is
+            named after (HG01.vcf -> HG01.vcf.gz, with the inserted
+            records listed in HG01.vcf.gz.inserted)
+        source: a string path to the sorted control vcf
+        orph_disease: an orpha.Disease instance to infect patient with
+        rev_hgmd: a dict of OMIM number -> list(hgmd.Entry)
+    """
+    # Sample variants
+    variants = sample_variants(rev_hgmd, orph_disease)
+
+    assert patient.endswith('.vcf')
+
+    lines = [generate_vcf_line(variant, hom=hom) for variant, hom in variants]
+    vcfio.write_sorted_vcf(source, patient + '.gz', lines)
 
 def weighted_choice(choices, weights):
     """Return a random choice, given corresponding weights
@@ -234,40 +393,259 @@ def weighted_choice(choices, weights):
         if total < threshold:
             return choices[k]
 
-def load_data(data_path):
+class DiseaseSampler(object):
+    """Draw random Orphanet diseases from a filtered lookup
+
+    Built once after filtering, so a draw is a single random number (and
+    a bisect over cumulative weights if sampling by variant) instead of a
+    pass over every disease.
+
+    Attributes:
+    lookup: dict of Orphanet number -> orpha.Disease
+    orphanums: sorted list of Orphanet numbers that can be drawn
+    cum_weights: cumulative variant counts parallel to orphanums,
+        or None when sampling uniformly (also kept as a numpy array for
+        sample_many)
+    """
+    def __init__(self, lookup, rev_hgmd=None, by_variant=False):
+        self.lookup = lookup
+        self.orphanums = sorted(lookup)
+        self.cum_weights = None
+        assert self.orphanums, "No diseases to sample from"
+
+        if by_variant:
+            # Weight each disease by the number of associated harmful variants
+            self.cum_weights = []
+            total = 0
+            for orphanum in self.orphanums:
+                total += len(rev_hgmd[lookup[orphanum].geno[0]])
+                self.cum_weights.append(total)
+            assert total > 0, "No variants to weight diseases by"
+            self._cum_weight_array = numpy.array(self.cum_weights, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.orphanums)
+
+    def sample(self):
+        """Return a random (Orphanet number, orpha.Disease) tuple"""
+        if self.cum_weights is None:
+            orphanum = random.choice(self.orphanums)
+        else:
+            threshold = random.random() * self.cum_weights[-1]
+            k = bisect.bisect_right(self.cum_weights, threshold)
+            orphanum = self.orphanums[k]
+        return orphanum, self.lookup[orphanum]
+
+    def sample_many(self, num):
+        """Return a list of num random (Orphanet number, orpha.Disease) tuples
+
+        All num draws are made at once with numpy.random, so they differ
+        from num calls to sample, which use random.
+        """
+        if self.cum_weights is None:
+            ks = numpy.random.randint(len(self.orphanums), size=num)
+        else:
+            thresholds = numpy.random.random_sample(num) * self.cum_weights[-1]
+            ks = numpy.searchsorted(self._cum_weight_array, thresholds, side='right')
+        orphanums = self.orphanums
+        lookup = self.lookup
+        return [(orphanums[k], lookup[orphanums[k]]) for k in ks]
+
+def sample_seed(seed, i):
+    """Return the seed for sample i of a run with the given master seed"""
+    return int(hashlib.md5('%d:%d' % (seed, i)).hexdigest()[:8], 16)
+
+def generate_sample(i, seed, state):
+    """Generate sample i (a pair or a single patient) of a run
+
+    All randomness is drawn after seeding from the master seed and i, so
+    the output does not depend on which process generates which sample.
+
+    Args:
+        i: index of the sample in the run
+        seed: master seed of the run
+        state: dict of the loaded data and run options (see script)
+
+    Returns:
+        A (i, seed of sample, list of files written) tuple
+    """
+    seed = sample_seed(seed, i)
+    random.seed(seed)
+    numpy.random.seed(seed)
+
+    vcf_path = state['vcf_path']
+    out_path = state['out_path']
+
+    # First, get a disease
+    orphanum, disease = state['sampler'].sample()
+
+    # Next, if we have a vcf dir copy over a pair or a single patient
+    # (or just pick them, if only writing deltas)
+    num_vcf = 2 if state['generate'] == 'PAIRS' else 1
+    if vcf_path and (state['delta'] or state['sorted_output']):
+        sources, patients = choose_vcf(state['vcf_files'], orphanum, i, num_vcf)
+        # These write their own files, named after an uncompressed vcf
+        patients = [vcfio.strip_vcf_ext(patient) + '.vcf' for patient in patients]
+    elif vcf_path:
+        patients = copy_vcf(state['vcf_files'], vcf_path, out_path, orphanum, i, num_vcf)
+    elif num_vcf == 2:
+        # Otherwise, name patients based on just disease and iteration (with fake vcf)
+        patients = ['First_' + orphanum + '_' + str(i) + '.vcf',
+                'Second_' + orphanum + '_' + str(i) + '.vcf']
+    else:
+        patients = [orphanum + '_' + str(i) + '.vcf']
+
+    # Finally, infect patients with geno and pheno
+    phenotype_sets = sample_many_phenotypes(state['omim_dict'], disease, len(patients),
+            state['hp'], state['imprecision'], state['noise'], state['default_freq'],
+            state['noise_pool'], state['matrix'])
+    files = []
+    for k, (patient, phenotypes) in enumerate(zip(patients, phenotype_sets)):
+        if vcf_path and state['delta']:
+            infect_delta(os.path.join(out_path, patient), os.path.join(vcf_path, sources[k]),
+                    disease, state['rev_hgmd'], phenotypes)
+            files.append(patient + '.delta')
+        elif vcf_path and state['sorted_output']:
+            infect_sorted(os.path.join(out_path, patient), os.path.join(vcf_path, sources[k]),
+                    disease, state['rev_hgmd'])
+            files.extend([patient + '.gz', patient + '.gz' + vcfio.INSERTED_EXT])
+        elif vcf_path:
+            infect_geno(os.path.join(out_path, patient), disease, state['rev_hgmd'])
+            files.append(patient)
+        infect_pheno(os.path.join(out_path, patient), disease, state['omim_dict'],
+                state['hp'], state['imprecision'], state['noise'], state['default_freq'],
+                state['noise_pool'], phenotypes)
+        files.append(vcfio.strip_vcf_ext(patient) + '_hpo.txt')
+
+    return i, seed, files
+
+# Run state of a worker process, set by init_worker
+_worker_state = None
+
+def init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+def generate_sample_worker(args):
+    i, seed = args
+    return generate_sample(i, seed, _worker_state)
+
+def load_hgmd(filename):
+    """Return the HGMD in filename, loaded lazily, since only the variants
+    of the sampled diseases are ever needed"""
+    return HGMD(filename, lazy=True)
+
+def load_hpo(filename):
+    """Return the HPO in filename, filtered to phenotypic abnormalities"""
+    hp = hpo.HPO(filename)
+    hp.filter_to_descendants('HP:0000118')
+    return hp
+
+class LoadError(Exception):
+    pass
+
+# Below this total size of the source files, parsing them in turn is
+# faster than forking a process pool
+MIN_POOL_BYTES = 4 * 2 ** 20
+
+def timed_load(name, func, filename):
+    """Return (seconds, result) of calling func(filename)
+
+    Raises LoadError naming the source and file, with the traceback of
+    the original error (which is otherwise lost across processes)
+    """
+    start = time.time()
+    try:
+        result = func(filename)
+    except Exception:
+        raise LoadError("Error loading %s from %s:\n%s" % (name, filename,
+                traceback.format_exc().rstrip()))
+    return time.time() - start, result
+
+def load_data(data_path, use_snapshot=True, processes=None):
     """Load all the required data files the program needs
+
+    The source files are independent, so they are parsed concurrently in
+    a process pool and only combined once all are loaded.
     
     Args:
         data_path: String file path to the directory files are in
+        use_snapshot: whether to load a compiled snapshot (see snapshot.py)
+            instead of parsing, if one is present and up to date
+        processes: number of processes to parse with (default is one per
+            source file, up to the number of CPUs, or 1 if the files are
+            small; 1 parses them in turn in this process)
 
     Returns
         (HGMD, OMIM number -> omim.Disease, Orphanet, HPO)
-    """
-    # Load hgmd
-    hgmd = HGMD(os.path.join(data_path, 'hgmd_correct.jv.vcf'))
-    
-    # Load hpo
-    hp = hpo.HPO(os.path.join(data_path, 'hp.obo'))
-    # Filter to phenotypic abnormailities
-    hp.filter_to_descendants('HP:0000118')
 
-    # Load and filter OMIM into an OMIM number: Disease dict, 
+    Raises LoadError if a source file cannot be loaded
+    """
+    if use_snapshot:
+        data = snapshot.read_snapshot(data_path)
+        if data is not None:
+            return data
+
+    sources = [('hgmd', load_hgmd, 'hgmd_correct.jv.vcf'),
+               ('hpo', load_hpo, 'hp.obo'),
+               ('omim', MIM, 'phenotype_annotation.tab'),
+               ('orphanet lookup', orpha.read_lookup, 'orphanet_lookup.xml'),
+               ('orphanet inheritance', orpha.read_inheritance, 'orphanet_inher.xml'),
+               ('orphanet geno pheno', orpha.read_geno_pheno, 'orphanet_geno_pheno.xml')]
+    filenames = [os.path.join(data_path, filename) for name, func, filename in sources]
+    if processes is None:
+        processes = min(len(sources), multiprocessing.cpu_count())
+        if sum(os.path.getsize(filename) for filename in filenames
+               if os.path.isfile(filename)) < MIN_POOL_BYTES:
+            processes = 1
+
+    start = time.time()
+    if processes == 1:
+        results = [timed_load(name, func, filename)
+                   for (name, func, _), filename in zip(sources, filenames)]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = [pool.apply_async(timed_load, (name, func, filename))
+                       for (name, func, _), filename in zip(sources, filenames)]
+            results = [result.get() for result in results]
+        finally:
+            pool.close()
+            pool.join()
+
+    for (name, func, filename), (seconds, data) in zip(sources, results):
+        logging.info("Loaded %s in %.2fs" % (name, seconds))
+    logging.info("Loaded all sources in %.2fs" % (time.time() - start))
+    hgmd, hp, mim, orph_lookup, orph_inher, orph_geno_pheno = [data for seconds, data in results]
+
+    # Filter OMIM into an OMIM number: Disease dict, 
     # Drop everything that isn't a child of 118
-    mim = MIM(os.path.join(data_path, 'phenotype_annotation.tab'))
     omim = filter(lambda d:d.db == 'OMIM', mim.diseases)
     for o in omim:
-        o.phenotype_freqs = {pheno:freq for pheno,freq in o.phenotype_freqs.iteritems() if hp.hps.has_key(pheno)}
+        o.phenotype_freqs = {pheno:freq for pheno,freq in o.phenotype_freqs.iteritems() if pheno in hp.term_index}
     omim_dict = {dis.id:dis for dis in omim}
 
-    # Grab orphanet file names and then load orphanet data
-    orphanet_lookup = os.path.join(data_path, 'orphanet_lookup.xml')
-    orphanet_inher = os.path.join(data_path, 'orphanet_inher.xml')
-    orphanet_geno_pheno = os.path.join(data_path, 'orphanet_geno_pheno.xml')
-    orph = Orphanet(orphanet_lookup, orphanet_inher, orphanet_geno_pheno)
-
+    orph = Orphanet.from_parsed(orph_lookup, orph_inher, orph_geno_pheno)
     
     return hgmd, omim_dict, orph, hp
 
+def choose_vcf(vcf_files, orphanum, i, num_vcf):
+    """Sample at random from vcf_files and name the new patients
+
+    Args:
+        vcf_files: list of vcf files in source directory
+        orphanum: orphanet disease number do sign new file with
+        i: iteration to sign new file with 
+        num_vcf: number of vcf's to sample
+    Returns:
+        A (list of sampled vcf files, list of new patient names) tuple
+    """
+    old_pair = random.sample(vcf_files, num_vcf)
+    # Keep the extension, so HG01.vcf.gz -> HG01_orphanum_i.vcf.gz
+    new_pair = map(lambda x: vcfio.strip_vcf_ext(x) + '_' + orphanum + '_' + str(i) +
+            x[len(vcfio.strip_vcf_ext(x)):], old_pair)
+    return old_pair, new_pair
+
 def copy_vcf(vcf_files, vcf_path, out_path, orphanum, i, num_vcf):
     """Copy in a new vcf group, sampling at random from vcf_files
 
@@ -281,119 +659,163 @@ def copy_vcf(vcf_files, vcf_path, out_path, orphanum, i, num_vcf):
     Returns:
         A list of the new patient locations
     """
-
-    old_pair = random.sample(vcf_files, num_vcf)
-    new_pair = map(lambda x: x[:-4] + '_' + orphanum + '_' + str(i) + '.vcf', old_pair)
+    old_pair, new_pair = choose_vcf(vcf_files, orphanum, i, num_vcf)
     for old, new in zip(old_pair, new_pair):
         shutil.copy(os.path.join(vcf_path, old), os.path.join(out_path, new))         
     return new_pair
 
 def drop_intronic_variants(hgmd):
-    """Drop all intronic variants in the given hgmd instance
+    """Return a view of the given hgmd instance without intronic variants
     
     Args:
         hgmd: an hgmd instance
     """
-    dropped_counter = 0
-    # We make a list of accepted effects
-    accepted = ['FS_DELETION', 'FS_SUBSTITUTION', 'NON_FS_DELETION', 
-            'NON_FS_SUBSTITUTION', 'NONSYNONYMOUS', 'SPLICING', 
-            'STOPGAIN', 'STOPLOSS']
-
-    # Also make a list of rejected effects, so we know when something is totally wrong
-    rejected = ['ERROR', 'INTERGENIC', 'INTRONIC', 'ncRNA_EXONIC', 
-            'ncRNA_SPLICING', 'SYNONYMOUS', 'UTR3', 'UTR5']
-
-    new_entries = []
-    for entry in hgmd.entries:
-        if entry.effect in accepted:
-            new_entries.append(entry)
-        elif entry.effect in rejected:
-            dropped_counter += 1
-        else:
-            logging.error("Entry did not have matched effect %s\n" % entry)
+    # Check the rejected effects too, so we know when something is totally wrong
+    effects = CODING_EFFECTS + NONCODING_EFFECTS
+    for entry in hgmd.with_effects([e for e in hgmd.effects if e not in effects]):
+        logging.error("Entry did not have matched effect %s\n" % entry)
+    dropped_counter = len(hgmd.with_effects(NONCODING_EFFECTS))
     logging.warning("%d HGMD variants dropped as intronic\n" % dropped_counter)
 
-    #Finally, reassign
-    hgmd.entries = new_entries
+    return hgmd.with_effects(CODING_EFFECTS)
+
+# Inheritance options the eligible disease table is precomputed for
+INHERITANCE_SETS = [[], ['AD'], ['AR'], ['AD', 'AR']]
+
+def eligible_key(inheritance, drop_intronic):
+    """Return the key of the eligible disease table for the given options"""
+    return tuple(sorted(set(inheritance or []))), bool(drop_intronic)
+
+def eligible_table(hgmd, omim_dict, orph):
+    """Return the eligible disease table for the loaded data
+
+    Args:
+        hgmd, omim_dict, orph: as returned by load_data
+
+    Returns:
+        dict of eligible_key -> sorted list of the Orphanet numbers of the
+        diseases which can be sampled with those options (see
+        Orphanet.filter_lookup), for every inheritance set in
+        INHERITANCE_SETS, with and without intronic variants dropped
+    """
+    table = {}
+    for drop_intronic in [False, True]:
+        if drop_intronic:
+            hgmd = drop_intronic_variants(hgmd)
+        rev_hgmd = hgmd.get_by_omim()
+        for inheritance in INHERITANCE_SETS:
+            lookup = orph.filter_lookup(orph.lookup, omim_dict, rev_hgmd, inheritance)
+            table[eligible_key(inheritance, drop_intronic)] = sorted(lookup)
+    return table
+
+def eligible_diseases(data_path, orph, omim_dict, rev_hgmd, inheritance=None,
+        drop_intronic=False, use_snapshot=True):
+    """Return the diseases which can be sampled with the given options
+
+    The Orphanet numbers are taken from the eligible disease table compiled
+    next to the data (see snapshot.py) when it is up to date, otherwise the
+    lookup is filtered here.
+
+    Args:
+        data_path: String file path to the directory files are in
+        orph: Orphanet instance
+        omim_dict: OMIM number -> omim.Disease
+        rev_hgmd: OMIM number -> list(hgmd.Entry), after dropping intronic
+            variants if drop_intronic
+        inheritance: list of accepted inheritance patterns ('AD', 'AR')
+        drop_intronic: whether intronic variants were dropped from HGMD
+        use_snapshot: whether to use the compiled eligible disease table
+
+    Returns:
+        dict of Orphanet number -> orpha.Disease
+    """
+    if use_snapshot:
+        table = snapshot.read_eligible(data_path)
+        key = eligible_key(inheritance, drop_intronic)
+        if table is not None and key in table:
+            return {orphanum: orph.lookup[orphanum] for orphanum in table[key]}
+    return orph.filter_lookup(orph.lookup, omim_dict, rev_hgmd, inheritance)
 
 def script(data_path, vcf_path, out_path, generate, num_samples, by_variant, default_freq, 
-        drop_intronic, imprecision, noise, inheritance=None, **kwargs):
+        drop_intronic, imprecision, noise, distinct_noise=False, inheritance=None,
+        reparse=False, seed=None, workers=1, delta=False, sorted_output=False,
+        resume=False, chunk_size=100, **kwargs):
+    # Options which must be the same to resume a run
+    options = {'data_path': data_path, 'vcf_path': vcf_path, 'generate': generate,
+               'by_variant': by_variant, 'default_freq': default_freq,
+               'drop_intronic': drop_intronic, 'imprecision': imprecision, 'noise': noise,
+               'distinct_noise': distinct_noise, 'inheritance': sorted(inheritance or []),
+               'delta': delta, 'sorted_output': sorted_output}
+    if resume:
+        try:
+            manifest = Manifest.resume(out_path, options, seed, chunk_size)
+        except ManifestError, e:
+            logging.error(e)
+            sys.exit(1)
+        seed = manifest.seed
+
     try:
-        hgmd, omim_dict, orph, hp = load_data(data_path)
-    except IOError, e:
+        hgmd, omim_dict, orph, hp = load_data(data_path, use_snapshot=not reparse)
+    except (IOError, LoadError), e:
         logging.error(e)
         sys.exit(1)
   
     # If we are dropping intronic variants from hgmd, do it now
     if drop_intronic:
-        drop_intronic_variants(hgmd)
+        hgmd = drop_intronic_variants(hgmd)
 
     # Set up our corrected lookup
     rev_hgmd = hgmd.get_by_omim()
-    orph_diseases = orph.filter_lookup(orph.lookup, omim_dict, rev_hgmd, inheritance)
+    orph_diseases = eligible_diseases(data_path, orph, omim_dict, rev_hgmd,
+            inheritance, drop_intronic, use_snapshot=not reparse)
+    # Sample diseases uniformly, or weighted by the number of associated harmful variants
+    sampler = DiseaseSampler(orph_diseases, rev_hgmd, by_variant)
+    # Phenotypes to draw noise from
+    # Phenotypes and frequencies of every disease, which phenotypes and
+    # noise are drawn from
+    matrix = phenotype_matrix(omim_dict)
+    noise_pool = NoisePool(matrix, distinct_noise) if noise else None
 
     # If vcf dir given, need to check there are at least 2 vcf files
+    vcf_files = None
     if vcf_path:
         contents = os.listdir(vcf_path)
-        vcf_files = filter(lambda x: x.endswith('.vcf'), contents)
+        vcf_files = sorted(filter(vcfio.is_vcf, contents))
         assert len(vcf_files) > 2, "Need at least 2 vcf files"
-    
-    # Dealing with pairs
-    if generate == 'PAIRS':
-        for i in range(num_samples):
-            # First, get a disease
-            if by_variant:
-                # We do a weighted sample based on the number of associated harmful variants
-                orphanum = weighted_choice(orph_diseases.keys(), 
-                    [len(rev_hgmd[x.geno[0]]) for x in orph_diseases.itervalues()])
-                disease = orph_diseases[orphanum]
-            else:
-                # A uniform sample over all diseases
-                orphanum = random.choice(orph_diseases.keys())
-                disease = orph_diseases[orphanum]
-
-            # Next, if we have a vcf dir copy pair
-            if vcf_path:
-                new_pair = copy_vcf(vcf_files, vcf_path, out_path, orphanum, i, 2)
-            else:
-                # Otherwise, name patients based on just disease and iteration (with fake vcf)
-                new_pair = ['First_' + orphanum + '_' + str(i) + '.vcf',
-                        'Second_' + orphanum + '_' + str(i) + '.vcf']
-
-            # Finally, infect both patients with disease
-            for patient in new_pair:
-                if vcf_path:
-                    infect_geno(os.path.join(out_path, patient), disease, rev_hgmd)
-                infect_pheno(os.path.join(out_path, patient), disease, omim_dict, 
-                        hp, imprecision, noise, default_freq)
-
-    # Dealing with individual patients
-    if generate == 'PATIENTS':
-        for i in range(num_samples):
-            # First, get a disease
-            if by_variant:
-                # We do a weighted sample based on the number of associated harmful variants
-                orphanum = weighted_choice(orph_diseases.keys(), 
-                    [len(rev_hgmd[x.geno[0]]) for x in orph_diseases.itervalues()])
-                disease = orph_diseases[orphanum]
-            else:
-                # A uniform sample over all diseases
-                orphanum = random.choice(orph_diseases.keys())
-                disease = orph_diseases[orphanum]
-            
-            # Next, if we have a vcf dir copy one over 
-            if vcf_path:
-                new_patient = copy_vcf(vcf_files, vcf_path, out_path, orphanum, i, 1)[0]
-            else:
-                # Otherwise, name patient based on just disease and iteration (with fake vcf)
-                new_patient = orphanum + '_' + str(i) + '.vcf'
-
-            # Finally, infect patient with geno and pheno
-            if vcf_path:
-                infect_geno(os.path.join(out_path, new_patient), disease, rev_hgmd)
-            infect_pheno(os.path.join(out_path, new_patient), disease, omim_dict, 
-                    hp, imprecision, noise, default_freq)
+
+    # Every sample is seeded from the master seed, so pick one if not given
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+        logging.warning("No seed given, using seed %d" % seed)
+    if not resume:
+        manifest = Manifest.create(out_path, seed, options, chunk_size)
+    samples = [(i, seed) for i in range(num_samples) if i not in manifest.done]
+
+    state = {'generate': generate, 'sampler': sampler, 'omim_dict': omim_dict,
+             'rev_hgmd': rev_hgmd, 'hp': hp, 'noise_pool': noise_pool,
+             'matrix': matrix,
+             'vcf_files': vcf_files, 'vcf_path': vcf_path, 'out_path': out_path,
+             'imprecision': imprecision, 'noise': noise, 'default_freq': default_freq,
+             'delta': delta, 'sorted_output': sorted_output}
+    try:
+        if workers > 1:
+            # Workers are forked, so each gets the loaded data once via initargs
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(state,))
+            try:
+                for done in pool.imap_unordered(generate_sample_worker, samples, chunksize=16):
+                    manifest.add(*done)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for i, seed in samples:
+                manifest.add(*generate_sample(i, seed, state))
+    finally:
+        # Keep a record of everything finished, even if the run failed
+        manifest.flush()
 
 def parse_args(args):
     parser = ArgumentParser(description=__doc__.strip())
@@ -424,12 +846,39 @@ def parse_args(args):
             help='Add phenotypic noise (random phenotypes). Recommended'
             'amount is 0.5 (i.e., half of the real amount will be added'
             'as noise).')
+    parser.add_argument('--distinct_noise', action='store_true',
+            help='Only add noise phenotypes the patient does not already have')
     parser.add_argument('-V', dest='by_variant', action='store_true',
             help='Sample diseases weighted by variant, default is uniform')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--delta', action='store_true',
+            help='Instead of copying control vcfs, write a .delta file per'
+            ' patient referring to its control (materialize with delta.py)')
+    output.add_argument('--sorted', dest='sorted_output', action='store_true',
+            help='Merge inserted variants into the (sorted) control vcfs in'
+            ' coordinate order, writing BGZF .vcf.gz files with the inserted'
+            ' records listed in a .vcf.gz.inserted sidecar')
+    parser.add_argument('--seed', type=int,
+            help='Master random seed; output is identical for a given seed'
+            ' whatever the number of workers (default is random)')
+    parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes to generate samples with (default is 1)')
+    parser.add_argument('--resume', action='store_true',
+            help='Resume an interrupted run in OUT, skipping samples listed'
+            ' as done in its manifest')
+    parser.add_argument('--chunk_size', type=int, default=100,
+            help='Number of completed samples to record in the manifest at'
+            ' a time (default is 100)')
+    parser.add_argument('--reparse', action='store_true',
+            help='Parse the data files even if a compiled snapshot is up to date')
     parser.add_argument('--logging', default='WARNING',
             choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
             help='Logging level')
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    # Both modes write output derived from the control vcfs
+    if (args.delta or args.sorted_output) and not args.vcf_path:
+        parser.error('--delta and --sorted require --vcf_path')
+    return args
 
 def main(args = sys.argv[1:]):
     args = parse_args(args)
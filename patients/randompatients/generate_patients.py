@@ -61,11 +61,8 @@ def sample_phenotypes(omim, orph_disease):
     # Lookup OMIM entry for orphanet disease
     # Is the OMIM ID always the first?
     omim_id = orph_disease.pheno[0]
-
-    # Ideally, omim.py would be fixed so that the MIM object
-    # can be indexed with an ID.
-    omimd = next(x for x in omim if x.id == omim_id)
-    assert omimd, "Could not find OMIM entry for: %s" % omim_id
+    assert ('OMIM', omim_id) in omim, "Could not find OMIM entry for: %s" % omim_id
+    omimd = omim['OMIM', omim_id]
     
     # Sample phenotypes randomly (weighted by frequency info if present)
     phenotype_freqs = omimd.phenotype_freqs
@@ -120,7 +117,7 @@ def annotate_patient(patient, rev_hgmd, omim, lookup, by_variant, produce_omim=F
     Args:
       patient:
       rev_hgmd:
-      omim:
+      omim: a MIM object
       lookup:
       produce_omim:
     """
@@ -174,52 +171,23 @@ def annotate_patient_dir(patient_dir, rev_hgmd, omim, lookup, produce_omim, by_v
         if os.path.isfile(filepath) and (filepath.endswith('.vcf') or filepath.endswith('.vcf.gz')):
             annotate_patient(filepath, rev_hgmd, omim, lookup, produce_omim,by_variant) 
 
-def has_pattern(patterns, o):
-    return any(x in patterns for x in o.inheritance)
-
-def has_pheno(omim, o):
-    return any(x.id == o.pheno[0] for x in omim)
-
 def filter_lookup(lookup, omim, rev_hgmd, inheritance=None):
     """Return a new, filtered lookup based on inheritance and mapping ability.
 
+    The same filter as Orphanet.filter_lookup, so the same diseases are
+    eligible as for generate_patient_pairs.
+
     Args:
-      lookup: dict ??? -> ???
-      omim: ?
-      rev_hgmd: ?
-      inheritance: ?
+      lookup: dict of Orphanet number -> orpha.Disease
+      omim: a MIM object
+      rev_hgmd: dict of OMIM number -> list(hgmd.Entry)
+      inheritance: list of accepted inheritance patterns ('AD', 'AR')
 
     Returns:
-      a new lookup dict ??? -> ???
+      a new lookup dict of Orphanet number -> orpha.Disease
     """
-    # Get diseases with straightforward orphanet mappings
-    # Better variable name?
-    newlook = {k:v for k,v in lookup.iteritems() 
-               if len(v.pheno) == 1 and len(v.inheritance) == 1 and len(v.geno) == 1}
-    
-    # Filter diseases to any specified inheritance models
-    if inheritance:
-        patterns = []
-        if 'AD' in inheritance:
-             patterns.append('Autosomal dominant')
-        if 'AR' in inheritance:
-            patterns.append('Autosomal recessive')
-
-        newlook = {k:v for k,v in newlook.iteritems() if has_pattern(patterns, v)}
-    
-    # Ensure all orphanet cases have phenotypic annotations
-    lookup = {k:v for k,v in newlook.iteritems() if has_pheno(omim, v)}
-
-    # Ensure all orphanet cases have at least one associated variant
-    newlook = {}
-    for k, o in lookup.iteritems():
-        try:
-            a = rev_hgmd[o.geno[0]]
-            newlook[k] = o
-        except KeyError:
-            pass
-
-    return newlook
+    omim_ids = set(id for db, id in omim.index if db == 'OMIM')
+    return Orphanet.filter_lookup(lookup, omim_ids, rev_hgmd, inheritance)
 
 def script(pheno_file, hgmd_file, patient_path, orphanet_lookup, 
            orphanet_inher, orphanet_geno_pheno,  
@@ -228,13 +196,15 @@ def script(pheno_file, hgmd_file, patient_path, orphanet_lookup,
     # code a lot harder to read, and don't make things that much clearer for
     # the user in the case of an error. This is debatable though.
     try:
-        mim = MIM(pheno_file)
+        # Only the diseases which are sampled need to be parsed
+        mim = MIM(pheno_file, lazy=True)
     except IOError:
         logging.error("OMIM file not found or invalid")
         raise
  
     try:    
-        hgmd = HGMD(hgmd_file)
+        # Only the variants of the sampled diseases are needed
+        hgmd = HGMD(hgmd_file, lazy=True)
     except IOError:
         logging.error("HGMD file not found or invalid")
         raise
@@ -246,23 +216,21 @@ def script(pheno_file, hgmd_file, patient_path, orphanet_lookup,
         raise
 
 
-    omim = filter(lambda d: d.db == 'OMIM', mim.diseases)
-
     # Get hgmd variants by omim
     rev_hgmd = hgmd.get_by_omim()
 
     logging.debug(orph.lookup)
-    lookup = filter_lookup(orph.lookup, omim, rev_hgmd, inheritance)
+    lookup = filter_lookup(orph.lookup, mim, rev_hgmd, inheritance)
     
     if os.path.isdir(patient_path):
         # If we are given a directory, annotate each vcf.gz or vcf file in the 
         # directory assuming it is a patient
         logging.info("Processing directory of patient VCF files...")
-        annotate_patient_dir(patient_path, rev_hgmd, omim, lookup, produce_omim, by_variant)
+        annotate_patient_dir(patient_path, rev_hgmd, mim, lookup, produce_omim, by_variant)
     elif os.path.isfile(patient_path):
         # If we are given a single file just annotate it normally
         logging.info("Processing single patient VCF file...")
-        annotate_patient(patient_path, rev_hgmd, omim, lookup, produce_omim, by_variant)
+        annotate_patient(patient_path, rev_hgmd, mim, lookup, produce_omim, by_variant)
     else:
         logging.error("Patient file/folder not found or invalid")
 
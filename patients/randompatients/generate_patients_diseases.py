@@ -11,6 +11,7 @@ import os
 import sys
 import logging
 
+import vcfio
 import generate_patient_pairs as gp
 
 from argparse import ArgumentParser
@@ -18,39 +19,48 @@ from orpha import Orphanet
 from hgmd import HGMD
 from omim import MIM
 
-def script(data_path, vcf_path, out_path, num_per, drop_intronic, inheritance=None, **kwargs):
+def script(data_path, vcf_path, out_path, num_per, drop_intronic, noise=0.0,
+        distinct_noise=False, inheritance=None, **kwargs):
     try:
         hgmd, omim_dict, orph, hp = gp.load_data(data_path)
-    except IOError, e:
+    except (IOError, gp.LoadError), e:
         logging.error(e)
         sys.exit(1)
 
     # If we are dropping intronic variants from hgmd, do it now
     if drop_intronic:
-        gp.drop_intronic_variants(hgmd)
+        hgmd = gp.drop_intronic_variants(hgmd)
 
     # Set up our corrected lookup
     rev_hgmd = hgmd.get_by_omim()
-    orph_diseases = orph.filter_lookup(orph.lookup, omim_dict, rev_hgmd, inheritance)
-    
+    orph_diseases = gp.eligible_diseases(data_path, orph, omim_dict, rev_hgmd,
+            inheritance, drop_intronic)
+    # Phenotypes and frequencies of every disease, which phenotypes and
+    # noise are drawn from
+    matrix = gp.phenotype_matrix(omim_dict)
+    noise_pool = gp.NoisePool(matrix, distinct_noise) if noise else None
+
     # If vcf dir given, need to check there are at least 2 vcf files
     if vcf_path:
         contents = os.listdir(vcf_path)
-        vcf_files = filter(lambda x: x.endswith('.vcf'), contents)
+        vcf_files = sorted(filter(vcfio.is_vcf, contents))
         assert len(vcf_files) > 2, "Need at least 2 vcf files"
     
 
     for num, dis in orph_diseases.iteritems():
-        for i in range(num_per):
+        # Sample phenotypes for all patients with this disease at once
+        phenotype_sets = gp.sample_many_phenotypes(omim_dict, dis, num_per,
+                hp, False, noise, 1.0, noise_pool, matrix)
+        for i, phenotypes in enumerate(phenotype_sets):
             if vcf_path:
                 new_patient = gp.copy_vcf(vcf_files, vcf_path, out_path, num, i, 1)[0]
             else:
-                new_patient = orphanum + '_' + str(i) + '.vcf'
+                new_patient = num + '_' + str(i) + '.vcf'
 
             if vcf_path:
                 gp.infect_geno(os.path.join(out_path, new_patient), dis, rev_hgmd)
             gp.infect_pheno(os.path.join(out_path, new_patient), dis, omim_dict,
-                    hp, False, False, 1.0)
+                    hp, False, noise, 1.0, noise_pool, phenotypes)
 
 def parse_args(args):
     parser = ArgumentParser(description=__doc__.strip())
@@ -68,6 +78,11 @@ def parse_args(args):
             help='Which inheritance pattern sampled diseases should have')
     parser.add_argument('--drop_intronic', action='store_true',
             help='Drop intronic variants from HGMD')
+    parser.add_argument('--noise', type=float, default=0.0,
+            help='Add phenotypic noise (random phenotypes), as a fraction'
+            ' of the number of sampled phenotypes')
+    parser.add_argument('--distinct_noise', action='store_true',
+            help='Only add noise phenotypes the patient does not already have')
     return parser.parse_args(args)
 
 def main(args = sys.argv[1:]):
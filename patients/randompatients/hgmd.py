@@ -8,14 +8,29 @@ Parse an hgmd file in vcf format annotated (by Jannovar), returning an easy to u
 
 import os
 import sys
+import copy
 import logging
 
-from collections import defaultdict
+import numpy
+from array import array
+from collections import defaultdict, OrderedDict
 
 
 __author__ = 'Tal Friedman (talf301@gmail.com)'
 
-class Entry:
+# Effects of variants in (or splicing) the coding sequence, and all others
+CODING_EFFECTS = ['FS_DELETION', 'FS_SUBSTITUTION', 'NON_FS_DELETION',
+        'NON_FS_SUBSTITUTION', 'NONSYNONYMOUS', 'SPLICING',
+        'STOPGAIN', 'STOPLOSS']
+NONCODING_EFFECTS = ['ERROR', 'INTERGENIC', 'INTRONIC', 'ncRNA_EXONIC',
+        'ncRNA_SPLICING', 'SYNONYMOUS', 'UTR3', 'UTR5']
+# Loss of function and missense effects
+LOF_EFFECTS = ['FS_DELETION', 'FS_SUBSTITUTION', 'SPLICING', 'STOPGAIN', 'STOPLOSS']
+MISSENSE_EFFECTS = ['NONSYNONYMOUS']
+
+class Entry(object):
+    __slots__ = ('chrom', 'loc', 'ref', 'alt', 'effect', 'omimid', 'pmid', 'info_line')
+
     def __init__(self, chrom, loc, ref, alt, effect, pmid, omimid, info_line):
         self.chrom = chrom
         self.loc = loc
@@ -37,43 +52,340 @@ class Entry:
         return self.__str__()
     
     def get_phenotypes(self, omim):
-        if self.omimid: 
-            om = next(x for x in omim if x.id == self.omimid)
-        return list(om.phenotype_freqs)
-     
-class HGMD:
-    def __init__(self, filename):
-        self.entries = list(self.iter_lines(filename))
-    
+        """Return the phenotypes of this entry's OMIM disease, given a MIM object"""
+        if not self.omimid:
+            return []
+        return list(omim['OMIM', self.omimid].phenotype_freqs)
+
+def parse_record(line):
+    """Return the (chrom, position, ref, alt, effect, OMIM number, info) tuple
+    of a variant line, with position and OMIM number as ints, or None if
+    the line is malformed"""
+    info = line.rstrip().split('\t')
+    assert len(info) == 10, "Malformed line %s" % line
+
+    # INFO is EFFECT=...;HGVS=...;OMIM:...;PMID:...
+    info_line = info[7].strip()
+    fields = info_line.split(';')
+    try:
+        assert len(fields) >= 4
+        return (info[0], int(info[1]), info[3], info[4],
+                fields[0].split('=')[1], int(fields[2].split(':')[1]), info_line)
+    except (AssertionError, IndexError, ValueError):
+        logging.error("Malformed line %s" % line)
+        return None
+
+def iter_records(filename):
+    """Iterate through the variants in the given hgmd file, tokenizing each
+    line once
+
+    Yields:
+        tuples as returned by parse_record
+    """
+    with open(filename) as hgmd:
+        for line in hgmd:
+            if line == '\n': continue
+            if line[0] == '#': continue
+
+            record = parse_record(line)
+            if record is not None:
+                yield record
+
+def iter_record_offsets(filename):
+    """Iterate through the variants in the given hgmd file, reading only
+    what is needed to index them
+
+    Yields:
+        (byte offset of line, effect, OMIM number) tuples, for the lines
+        parse_record accepts
+    """
+    offset = 0
+    with open(filename, 'rb') as hgmd:
+        for line in hgmd:
+            start = offset
+            offset += len(line)
+            if line == '\n': continue
+            if line[0] == '#': continue
+
+            assert line.count('\t') == 9, "Malformed line %s" % line
+            tokens = line.split('\t', 8)
+            fields = tokens[7].strip().split(';', 4)
+            try:
+                assert len(fields) >= 4
+                int(tokens[1])
+                yield start, fields[0].split('=')[1], int(fields[2].split(':')[1])
+            except (AssertionError, IndexError, ValueError):
+                logging.error("Malformed line %s" % line)
+
+def make_entry(chrom, pos, ref, alt, effect, omimid, info_line):
+    """Return the Entry of the fields of a variant (see parse_record)"""
+    pmid = info_line.split(';')[3].partition(':')[2]
+    return Entry(chrom, str(pos), ref, alt, effect, pmid, str(omimid), info_line)
+
+class StringPool(object):
+    """A column of strings stored back to back in a single string
+
+    Strings are appended to a new StringPool, which must then be frozen
+    before it is read.
+
+    Attributes:
+    data: the concatenated strings
+    offsets: numpy array of len + 1 offsets, string i is data[offsets[i]:offsets[i + 1]]
+    """
+    def __init__(self):
+        self.data = array('c')
+        self.offsets = array('l', [0])
+
+    @classmethod
+    def from_strings(cls, strings):
+        """Return a frozen StringPool of the given iterable of strings"""
+        pool = cls()
+        for string in strings:
+            pool.append(string)
+        pool.freeze()
+        return pool
+
+    def append(self, string):
+        self.data.fromstring(string)
+        self.offsets.append(len(self.data))
+
+    def freeze(self):
+        """Pack the appended strings for reading"""
+        self.data = self.data.tostring()
+        self.offsets = numpy.frombuffer(self.offsets, dtype=numpy.dtype('l')).astype(numpy.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+class EntryList(object):
+    """A read-only list of the Entry views of some rows of an HGMD"""
+    __slots__ = ('hgmd', 'rows')
+
+    def __init__(self, hgmd, rows):
+        self.hgmd = hgmd
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return EntryList(self.hgmd, self.rows[i])
+        return self.hgmd.entry(self.rows[i])
+
     def __iter__(self):
-        return iter(self.entries)
-   
-    def iter_lines(self, filename):
-        """Iterate through the lines in given hgmd file, with each
-        line yielding a corresponding Entry object.
+        for row in self.rows:
+            yield self.hgmd.entry(row)
+
+    def __repr__(self):
+        return list(self).__repr__()
+
+class HGMD(object):
+    """The variants of an hgmd file, stored by column
+
+    Chromosomes and effects are stored as codes into lists of their names,
+    and the alleles and INFO fields of all variants as StringPools. Entry
+    objects are only made on request (see entry, get_by_omim).
+
+    An HGMD can also be a view of some of the variants of another (see
+    view, with_effects), sharing its columns and indexes, which are always
+    of all the variants in the file.
+
+    In lazy mode, only the effect, OMIM number and byte offset of each
+    variant are read up front. The variants of an OMIM number are parsed
+    together when one of them is first asked for, and kept in an LRU cache
+    of the cache_size most recently used OMIM numbers. Variants cannot be
+    looked up by position in lazy mode.
+
+    Attributes:
+    filename: hgmd file
+    lazy: whether variants are parsed on demand
+    offsets: numpy array of the byte offset of each variant in lazy mode,
+        otherwise None (as are the other columns in lazy mode, except
+        effect_codes and omimids)
+    rows: sorted numpy array of the rows in this view, or None for all
+    chroms: list of chromosome names
+    chrom_codes: numpy array of the chromosome code of each variant
+    positions: numpy array of positions
+    refs, alts: StringPools of reference and alternate alleles
+    effects: list of effect names
+    effect_codes: numpy array of the effect code of each variant
+    effect_rows: list of the numpy array of rows with each effect code
+    omimids: numpy array of OMIM numbers
+    infos: StringPool of INFO fields
+    omim_rows: numpy array of rows sorted by OMIM number (in file order for each)
+    omim_ranges: dict of OMIM number -> (start, end) of its rows in omim_rows
+    variant_keys: sorted numpy array of the (chromosome code, position) key
+        of each variant, or None until a variant is looked up
+    variant_rows: numpy array of the rows of variant_keys
+    """
+    def __init__(self, filename, lazy=False, cache_size=1024):
+        # Lazy variants are read later, maybe from another directory
+        self.filename = os.path.abspath(filename) if lazy else filename
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.rows = None
+        self._mask = None
+        self.variant_keys = self.variant_rows = None
+        if lazy:
+            self._read_offsets(filename)
+        else:
+            self._read_columns(filename)
+        self._index_effects()
+        self._index_omim()
+
+    def _read_offsets(self, filename):
+        """Read the offsets, effect codes and OMIM numbers of the variants"""
+        effects = {}
+        offsets = array('l')
+        effect_codes = array('B')
+        omimids = array('l')
+        for offset, effect, omimid in iter_record_offsets(filename):
+            offsets.append(offset)
+            effect_codes.append(effects.setdefault(effect, len(effects)))
+            omimids.append(omimid)
+
+        self.chroms = self.chrom_codes = self.positions = None
+        self.refs = self.alts = self.infos = None
+        self.offsets = numpy.frombuffer(offsets, dtype=numpy.dtype('l')).astype(numpy.int64)
+        self.effects = sorted(effects, key=effects.get)
+        self.effect_codes = numpy.frombuffer(effect_codes, dtype=numpy.uint8).copy()
+        self.omimids = numpy.frombuffer(omimids, dtype=numpy.dtype('l')).astype(numpy.int32)
+
+    def _read_columns(self, filename):
+        """Read all the columns of the variants"""
+        chroms = {}
+        effects = {}
+        chrom_codes = array('H')
+        positions = array('l')
+        effect_codes = array('B')
+        omimids = array('l')
+        self.refs = StringPool()
+        self.alts = StringPool()
+        self.infos = StringPool()
+        for chrom, pos, ref, alt, effect, omimid, info in iter_records(filename):
+            chrom_codes.append(chroms.setdefault(chrom, len(chroms)))
+            positions.append(pos)
+            self.refs.append(ref)
+            self.alts.append(alt)
+            effect_codes.append(effects.setdefault(effect, len(effects)))
+            omimids.append(omimid)
+            self.infos.append(info)
+
+        self.chroms = sorted(chroms, key=chroms.get)
+        self.chrom_codes = numpy.frombuffer(chrom_codes, dtype=numpy.uint16).copy()
+        self.positions = numpy.frombuffer(positions, dtype=numpy.dtype('l')).astype(numpy.int32)
+        self.refs.freeze()
+        self.alts.freeze()
+        self.effects = sorted(effects, key=effects.get)
+        self.effect_codes = numpy.frombuffer(effect_codes, dtype=numpy.uint8).copy()
+        self.omimids = numpy.frombuffer(omimids, dtype=numpy.dtype('l')).astype(numpy.int32)
+        self.infos.freeze()
+        self.offsets = None
+
+    def _index_effects(self):
+        """Build effect_rows"""
+        order = numpy.argsort(self.effect_codes, kind='mergesort')
+        ends = numpy.cumsum(numpy.bincount(self.effect_codes, minlength=len(self.effects)))
+        self.effect_rows = numpy.split(order, ends[:-1])
+
+    def _index_omim(self):
+        """Build omim_rows and omim_ranges"""
+        self.omim_rows = numpy.argsort(self.omimids, kind='mergesort')
+        sorted_omimids = self.omimids[self.omim_rows]
+        starts = numpy.flatnonzero(numpy.diff(sorted_omimids)) + 1
+        starts = [0] + starts.tolist()
+        ends = starts[1:] + [len(sorted_omimids)]
+        self.omim_ranges = {str(sorted_omimids[start]): (start, end)
+                for start, end in zip(starts, ends) if start < end}
+
+    def _index_variants(self):
+        """Build variant_keys and variant_rows"""
+        keys = (self.chrom_codes.astype(numpy.int64) << 32) | self.positions
+        self.variant_rows = numpy.argsort(keys, kind='mergesort')
+        self.variant_keys = keys[self.variant_rows]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        if self.rows is None:
+            return len(self.omimids)
+        return len(self.rows)
+
+    def __iter__(self):
+        rows = xrange(len(self.omimids)) if self.rows is None else self.rows
+        for row in rows:
+            yield self.entry(row)
+
+    @property
+    def entries(self):
+        """List of the Entry views of all variants"""
+        return list(self)
+
+    def entry(self, row):
+        """Return an Entry view of the given row"""
+        if self.lazy:
+            return self._omim_entries(self.omimids[row])[row]
+
+        return make_entry(self.chroms[self.chrom_codes[row]], self.positions[row],
+                self.refs[row], self.alts[row], self.effects[self.effect_codes[row]],
+                self.omimids[row], self.infos[row])
+
+    def _omim_entries(self, omimid):
+        """Return a dict of row -> Entry of all the variants of an OMIM number,
+        parsing them if they are not cached"""
+        entries = self._cache.pop(omimid, None)
+        if entries is None:
+            start, end = self.omim_ranges[str(omimid)]
+            entries = {}
+            with open(self.filename, 'rb') as ifp:
+                for row in self.omim_rows[start:end].tolist():
+                    ifp.seek(self.offsets[row])
+                    entries[row] = make_entry(*parse_record(ifp.readline()))
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[omimid] = entries
+        return entries
+
+    def view(self, rows):
+        """Return a view of the given rows, without copying any columns
+
+        Args:
+            rows: sorted numpy array of rows, all in this view
         """
-        with open(filename) as hgmd:
-            for line in hgmd:
-                if line == '\n': continue
-                if line[0] == '#': continue
-
-                info = line.rstrip().split('\t')
-                assert len(info) == 10, "Malformed line %s" % line
-                
-                try:
-                    info_line = info[7]
-                    effect = info_line.split(';')[0].split('=')[1]
-                    omimid = info_line.split(';')[2].split(':')[1]
-                    pmid = info_line.split(';')[3].split(':')[1]      
-                except IndexError:
-                    logging.error("Malformed line %s" % line)
-                try:
-                    yield Entry(info[0],info[1],info[3],info[4],effect,pmid,omimid,info[7].strip())
-                except ValueError:
-                    logging.error("Malformed line %s" % line)
- 
-    def __str__(self):
-        return self.line
+        if self.variant_keys is None and not self.lazy:
+            # Build now, so all views share it
+            self._index_variants()
+        view = copy.copy(self)
+        view._cache = self._cache
+        view.rows = rows
+        view._mask = numpy.zeros(len(self.omimids), dtype=bool)
+        view._mask[rows] = True
+        return view
+
+    def with_effects(self, effects):
+        """Return a view of the variants with any of the given effects
+
+        Args:
+            effects: A list of strings representing the desired effects
+        """
+        rows = [self.effect_rows[code] for code, effect in enumerate(self.effects)
+                if effect in effects]
+        rows = numpy.sort(numpy.concatenate(rows)) if rows else numpy.array([], dtype=numpy.intp)
+        if self._mask is not None:
+            rows = rows[self._mask[rows]]
+        return self.view(rows)
 
     def get_entries_effects(self, effects):
         """Get all hgmd variants with a certain effect
@@ -82,20 +394,49 @@ class HGMD:
             effects: A list of strings representing the desired effects
 
         Returns:
-            A list a of hgmd variants with the given effect
+            An EntryList of hgmd variants with the given effect
+        """
+        view = self.with_effects(effects)
+        return EntryList(view, view.rows)
+
+    def get_by_variant(self, chrom, pos, ref=None, alt=None):
+        """Get the hgmd variants at a position, in file order
+
+        Args:
+            chrom: chromosome name
+            pos: int position
+            ref, alt: alleles the variants must also have, if given
+
+        Returns:
+            An EntryList of the matching hgmd variants
         """
-        returned = []
-        for e in self.entries:
-            if e.effect in effects:
-                returned += e
-        return returned
+        assert not self.lazy, "Variant lookup needs an HGMD loaded with lazy=False"
+        if self.variant_keys is None:
+            self._index_variants()
+        try:
+            key = (self.chroms.index(chrom) << 32) | pos
+        except ValueError:
+            return EntryList(self, [])
+        start, end = numpy.searchsorted(self.variant_keys, [key, key + 1])
+        rows = [row for row in self.variant_rows[start:end].tolist()
+                if (self._mask is None or self._mask[row])
+                and (ref is None or self.refs[row] == ref)
+                and (alt is None or self.alts[row] == alt)]
+        return EntryList(self, rows)
 
     def get_by_omim(self):
-        oentries = filter(lambda x: x.omimid, self.entries)
-        ret = {}
-        for o in oentries:
-            ret.setdefault(o.omimid, []).append(o)
-        return ret
+        """Return a dict of OMIM number -> EntryList of its variants"""
+        if self._mask is None:
+            return {omimid: EntryList(self, self.omim_rows[start:end])
+                    for omimid, (start, end) in self.omim_ranges.iteritems()}
+
+        # Narrow each OMIM range to the rows in this view
+        in_view = self._mask[self.omim_rows]
+        omim_rows = self.omim_rows[in_view]
+        counts = [0] + numpy.cumsum(in_view).tolist()
+        return {omimid: EntryList(self, omim_rows[counts[start]:counts[end]])
+                for omimid, (start, end) in self.omim_ranges.iteritems()
+                if counts[start] < counts[end]}
 
 if __name__ == '__main__':
     try:
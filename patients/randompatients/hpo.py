@@ -9,8 +9,15 @@ __author__ = 'Orion Buske'
 import os
 import sys
 import re
+import math
+import random
 import logging
 
+import numpy
+from array import array
+from collections import Mapping
+from omim import MIM, PhenotypeMatrix
+
 
 class HPError(Exception):
     pass
@@ -20,68 +27,141 @@ class HPObsoleteError(HPError):
 
 
 
-def get_descendants(root, acc=None):
-    """Add to acc all descendants of root"""
-    if acc is None:
-        acc = set()
-    acc.add(root)
-    for child in root.children:
-        get_descendants(child, acc)
-    return acc
+# Number of nodes whose ancestors are found at once by ancestor_closure
+CLOSURE_BATCH_SIZE = 1024
+
+def _gather_ranges(starts, lengths):
+    """Return the concatenated ranges [start, start + length) as one array"""
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    ends = numpy.cumsum(lengths)
+    offsets = numpy.asarray(starts, dtype=numpy.int64) - (ends - lengths)
+    return numpy.repeat(offsets, lengths) + numpy.arange(ends[-1] if len(ends) else 0)
+
+def ancestor_closure(parent_ptr, parent_ids):
+    """Return the ancestors of every node of a DAG, in CSR form
+
+    Nodes are visited a level at a time from the roots down, so the
+    ancestors of a whole level are the union of its parents' ancestors,
+    which are already complete, and are found with a few array operations.
 
-def get_ancestors(root, acc=None):
-    if acc is None:
-        acc = set()
-    acc.add(root)
-    for parent in root.parents:
-        get_ancestors(parent, acc)
-    return acc
+    Args:
+        parent_ptr, parent_ids: the parents of each node in CSR form
+
+    Returns:
+        (ptr, ids) arrays, where the ids of the ancestors of node k
+        (including k) are ids[ptr[k]:ptr[k + 1]], in increasing order
+
+    Raises HPError if the graph has a cycle
+    """
+    num = len(parent_ptr) - 1
+    parent_ptr = numpy.asarray(parent_ptr, dtype=numpy.int64)
+    parent_ids = numpy.asarray(parent_ids, dtype=numpy.int64)
+    num_parents = numpy.diff(parent_ptr)
+    child_ptr, child_ids = invert_adjacency(parent_ptr, parent_ids)
+    num_children = numpy.diff(child_ptr)
+
+    # Ancestors of node k are closure[starts[k]:starts[k] + lengths[k]]
+    closure = numpy.zeros(0, dtype=numpy.int32)
+    starts = numpy.zeros(num, dtype=numpy.int64)
+    lengths = numpy.zeros(num, dtype=numpy.int64)
+    num_pending = num_parents.copy()
+    num_done = 0
+    level = numpy.flatnonzero(num_parents == 0)
+    while len(level):
+        # Nodes of a level are independent, so do them in batches to
+        # bound the size of the intermediate arrays
+        chunks = [closure]
+        offset = len(closure)
+        for batch_start in range(0, len(level), CLOSURE_BATCH_SIZE):
+            batch = level[batch_start:batch_start + CLOSURE_BATCH_SIZE]
+            # (node, parent) pairs, then (node, ancestor) pairs including itself
+            nodes = numpy.repeat(batch, num_parents[batch])
+            parents = parent_ids[_gather_ranges(parent_ptr[batch], num_parents[batch])]
+            nodes = numpy.concatenate([batch, numpy.repeat(nodes, lengths[parents])])
+            ancestors = numpy.concatenate([batch,
+                    closure[_gather_ranges(starts[parents], lengths[parents])]])
+
+            # Sort and deduplicate by node, then ancestor
+            pairs = numpy.unique(nodes * num + ancestors)
+            nodes = pairs // num
+            first = numpy.searchsorted(nodes, batch)
+            starts[batch] = offset + first
+            lengths[batch] = numpy.searchsorted(nodes, batch, side='right') - first
+            chunks.append((pairs % num).astype(numpy.int32))
+            offset += len(pairs)
+        closure = numpy.concatenate(chunks)
+        num_done += len(level)
+
+        # The next level is the children with no parents left to visit
+        children = child_ids[_gather_ranges(child_ptr[level], num_children[level])]
+        numpy.subtract.at(num_pending, children, 1)
+        level = numpy.unique(children[num_pending[children] == 0])
+
+    if num_done < num:
+        raise HPError("HPO graph has a cycle")
+
+    ptr = numpy.zeros(num + 1, dtype=numpy.int32)
+    ptr[1:] = numpy.cumsum(lengths)
+    # Put the ancestor lists in node order, a batch at a time
+    ids = numpy.empty(ptr[-1], dtype=numpy.int32)
+    for start in range(0, num, CLOSURE_BATCH_SIZE):
+        end = min(start + CLOSURE_BATCH_SIZE, num)
+        ids[ptr[start]:ptr[end]] = closure[_gather_ranges(starts[start:end], lengths[start:end])]
+    return ptr, ids
+
+def invert_adjacency(ptr, ids):
+    """Return the inverse of a relation between nodes given in CSR form
+
+    E.g. the children of every node, given the parents, or the
+    descendants, given the ancestors. Inverted lists are in increasing order.
+    """
+    num = len(ptr) - 1
+    ptr = numpy.asarray(ptr)
+    ids = numpy.asarray(ids)
+    # A stable sort by id keeps the nodes listing each id in increasing order
+    nodes = numpy.repeat(numpy.arange(num, dtype=numpy.int32), numpy.diff(ptr))
+    inv_ptr = numpy.zeros(num + 1, dtype=numpy.int32)
+    inv_ptr[1:] = numpy.cumsum(numpy.bincount(ids, minlength=num))
+    return inv_ptr, nodes[numpy.argsort(ids, kind='mergesort')]
+
+def reachable(ptr, ids, start):
+    """Return the increasing integer ids of the nodes reachable from start
+    (including itself) in a graph given in CSR form, e.g. the descendants
+    of a node, given the children"""
+    ptr = numpy.asarray(ptr)
+    ids = numpy.asarray(ids)
+    seen = numpy.zeros(len(ptr) - 1, dtype=bool)
+    seen[start] = True
+    level = numpy.array([start])
+    while len(level):
+        found = ids[_gather_ranges(ptr[level], ptr[level + 1] - ptr[level])]
+        level = numpy.unique(found[~seen[found]])
+        seen[level] = True
+    return numpy.flatnonzero(seen)
 
 
 
 class HP(object):
-    """HPO graph node
+    """HPO graph node, created on demand by HPO from its arrays
 
     Attributes:
     id
     name
-    parents (HP objects, filled in by HPO)
-    children (HP objects, filled in by HPO)
+    index (integer term id)
     alts (HP terms)
+    parents (HP objects)
+    children (HP objects)
     """
-    def __init__(self, lines):
-        self.parents = set()
-        self.children = set()
-        self.alts = set()
-        self._parent_hps = set()
+    __slots__ = ('id', 'name', 'index', 'alts', '_hpo', '_ancestors', '_descendants')
+
+    def __init__(self, hpo, k):
+        self.id = hpo.term_ids[k]
+        self.name = hpo.term_names[k]
+        self.index = k
+        self.alts = hpo.term_alts[k]
+        self._hpo = hpo
         self._ancestors = None
-
-        for line in lines:
-            line = line.strip()
-            field, value = line.split(': ', 1)
-            if field == 'is_obsolete':
-                raise HPObsoleteError()
-            elif field == 'id':
-                assert value.startswith('HP:') and value[-1].isdigit(), value
-                self.id = value
-            elif field == 'name':
-                self.name = value
-            elif field == 'alt_id':
-                assert value.startswith('HP:') and value[-1].isdigit(), value
-                self.alts.add(value)
-            elif field == 'is_a':
-                hp = value.split('!')[0].strip()
-                assert hp.startswith('HP:') and hp[-1].isdigit(), value
-                self._parent_hps.add(hp)
-
-        try:
-            assert self.id
-            assert self.name
-            if self.id != 'HP:0000001':
-                assert self._parent_hps
-        except:
-            logging.error("Error parsing TERM:\n{}".format('\n'.join(lines)))
-            raise
+        self._descendants = None
 
     def __str__(self):
         return '{}: ({})'.format(self.id, self.name)
@@ -92,135 +172,462 @@ class HP(object):
     def __lt__(self, o):
         return self.id < o.id
 
-    def link(self, hps):
-        """Link to objects for parents and children, given lookup dict"""
-        for hp in self._parent_hps:
-            parent = hps[hp]
-            self.parents.add(parent)
-            parent.children.add(self)
+    @property
+    def parents(self):
+        hpo = self._hpo
+        return hpo._nodes_in(hpo.parent_ptr, hpo.parent_ids, self.index)
+
+    @property
+    def children(self):
+        hpo = self._hpo
+        return hpo._nodes_in(hpo.child_ptr, hpo.child_ids, self.index)
 
     def is_root(self):
-        return len(self._parent_hps) == 0
+        return self._hpo.parent_ptr[self.index] == self._hpo.parent_ptr[self.index + 1]
 
     def ancestors(self):
+        """Return the frozenset of ancestors (including self), built once"""
         if self._ancestors is None:
-            self._ancestors = get_ancestors(self)
+            hpo = self._hpo
+            self._ancestors = frozenset(hpo._nodes_in(hpo.ancestor_ptr, hpo.ancestor_ids, self.index))
         return self._ancestors
 
-def _iter_hp_terms(reader):
-    term_lines = None
-    for line in reader:
-        line = line.strip()
-        if not line: continue
-        if line == '[Term]':
-            if term_lines:
-                yield term_lines
-                
-            term_lines = []
-        else:
-            if term_lines is not None:
-                term_lines.append(line)
+    def descendants(self):
+        """Return the frozenset of descendants (including self), built once"""
+        if self._descendants is None:
+            hpo = self._hpo
+            self._descendants = frozenset(hpo._nodes_in(hpo.descendant_ptr, hpo.descendant_ids, self.index))
+        return self._descendants
 
-    if term_lines:
-        yield term_lines
 
+def _check_hp(value):
+    if not (value.startswith('HP:') and value[-1].isdigit()):
+        raise HPError("Invalid HP term: {}".format(value))
+    return value
 
-class HPO(object):
-    """HPO graph
+class OboTable(object):
+    """Terms of an OBO file, parsed in one streaming pass into flat arrays
+
+    Terms are numbered in file order, skipping obsolete ones. Load it
+    into a graph with HPO.
 
     Attributes:
-    version
-    hps: {hp -> HP}
-    root: HP
+    version: format version
+    ids: list of HP terms, indexed by integer term id
+    names: list of term names, likewise
+    alts: list of tuples of alternate HP terms, likewise
+    parent_ptr, parent_ids: parents in CSR form, where the integer ids of
+        the parents of term k are parent_ids[parent_ptr[k]:parent_ptr[k + 1]]
+    index: {hp (including alts) -> integer term id}
     """
     def __init__(self, filename):
-        self.hps = {}
-        self.root = None
+        self.ids = []
+        self.names = []
+        self.alts = []
+        self.index = {}
 
-        logging.info("Parsing HPO graph...")
-        roots = []
+        parent_hps = []
         with open(filename) as ifp:
             version_str = ifp.readline().strip()
             assert version_str.startswith('format-version')
             self.version = version_str.split(': ')[1]
-            logging.info("HPO version {}...".format(self.version))
-            
-            for lines in _iter_hp_terms(ifp):
-                try:
-                    hp = HP(lines)
-                except HPError:
+
+            # Fields of the current [Term] stanza, if in one
+            in_term = False
+            for line in ifp:
+                if line.startswith('['):
+                    if in_term:
+                        self._add_term(term, parent_hps)
+                    in_term = line.startswith('[Term]')
+                    term = [None, None, [], [], False]
+                elif not in_term:
                     continue
-                
-                if hp.is_root():
-                    roots.append(hp)
-                # Relate all alt HP ids to object
-                self.hps[hp.id] = hp
-                for hpid in hp.alts:
-                    assert hpid not in self.hps
-                    self.hps[hpid] = hp
-
-        # Connect network of HP objects
-        nodes = set(self.hps.values())
-        for node in nodes:
-            node.link(self.hps)
-
-        logging.info("Found {:d} HP nodes ({:d} terms) in graph".format(len(nodes), len(self.hps)))
+                elif line.startswith('is_a: '):
+                    term[3].append(line[6:].split('!', 1)[0].strip())
+                elif line.startswith('id: '):
+                    term[0] = line[4:].strip()
+                elif line.startswith('name: '):
+                    term[1] = line[6:].strip()
+                elif line.startswith('alt_id: '):
+                    term[2].append(line[8:].strip())
+                elif line.startswith('is_obsolete: '):
+                    term[4] = True
+            if in_term:
+                self._add_term(term, parent_hps)
+
+        # Resolve parents, which may be given by alternate id
+        self.parent_ptr = array('i', [0])
+        self.parent_ids = array('i')
+        for hps in parent_hps:
+            self.parent_ids.extend([self.index[_check_hp(hp)] for hp in hps])
+            self.parent_ptr.append(len(self.parent_ids))
+
+    def _add_term(self, term, parent_hps):
+        hp, name, alts, parents, obsolete = term
+        if obsolete:
+            return
+
+        if not hp or not name or (not parents and hp != 'HP:0000001'):
+            logging.error("Error parsing TERM: {}".format(hp))
+            raise HPError("Incomplete term: {}".format(hp))
+
+        k = len(self.ids)
+        self.ids.append(_check_hp(hp))
+        self.names.append(name)
+        self.alts.append(tuple(map(_check_hp, alts)))
+        parent_hps.append(parents)
+        self.index[hp] = k
+        for alt in alts:
+            assert alt not in self.index
+            self.index[alt] = k
+
+    def parents(self, k):
+        """Return the integer ids of the parents of term k"""
+        return self.parent_ids[self.parent_ptr[k]:self.parent_ptr[k + 1]]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class HPMapping(Mapping):
+    """Read-only {hp (including alts) -> HP} view of an HPO, whose nodes
+    are created on demand"""
+    def __init__(self, hpo):
+        self._hpo = hpo
+
+    def __getitem__(self, hp):
+        return self._hpo._node(self._hpo.term_index[hp])
+
+    def __contains__(self, hp):
+        return hp in self._hpo.term_index
+
+    def has_key(self, hp):
+        return hp in self._hpo.term_index
+
+    def __iter__(self):
+        return iter(self._hpo.term_index)
+
+    def __len__(self):
+        return len(self._hpo.term_index)
+
+
+class HPO(object):
+    """HPO graph
+
+    Terms are numbered by integer id, and the graph and its closures are
+    stored as arrays in CSR form: the integer ids of the parents of term k
+    are parent_ids[parent_ptr[k]:parent_ptr[k + 1]], and so on. The
+    closures are computed on first use, and HP nodes are created on
+    demand by indexing with an HP term.
+
+    Attributes:
+    version
+    hps: read-only {hp (including alts) -> HP} mapping (see HPMapping)
+    root: HP
+    term_ids: list of HP terms, indexed by integer term id (the root,
+        if any, has the largest id)
+    term_names: list of term names, likewise
+    term_alts: list of tuples of alternate HP terms, likewise
+    term_index: {hp (including alts) -> integer term id}
+    parent_ptr, parent_ids: parents of each term
+    child_ptr, child_ids: children of each term
+    ancestor_ptr, ancestor_ids: ancestors of each term (including
+        itself), in increasing order
+    descendant_ptr, descendant_ids: descendants of each term, likewise
+    """
+    def __init__(self, filename):
+        logging.info("Parsing HPO graph...")
+        table = OboTable(filename)
+        self.version = table.version
+        logging.info("HPO version {}...".format(self.version))
+        logging.info("Found {:d} HP nodes ({:d} terms) in graph".format(len(table), len(table.index)))
 
         logging.debug("Here are 5:")
-        for i, k in zip(list(range(5)), nodes):
-            logging.debug("  {:d}: {}".format(i, k))
+        for i, hp in enumerate(table.ids[:5]):
+            logging.debug("  {:d}: {}: ({})".format(i, hp, table.names[i]))
 
+        roots = numpy.flatnonzero(numpy.diff(table.parent_ptr) == 0)
         if len(roots) == 1:
-            self.root = roots[0]
+            root = roots[0]
         else:
             logging.warning("Warning: found {:d} root nodes, leaving root as None".format(len(roots)))
-            self.root = None
+            root = None
 
+        self._build(table.ids, table.names, table.alts, table.parent_ptr, table.parent_ids,
+                    range(len(table)), root)
 
     def filter_to_descendants(self, root_hp):
-        root = self.hps[root_hp]
-        
-        safe_nodes = get_descendants(root)
-        logging.info("Filtering to the {:d} nodes descendant of {} ({})...".format(len(safe_nodes), root_hp, root.name))
-
-        hps = {}
-        safe_hps = set()
-        for node in safe_nodes:
-            safe_hps.add(node.id)
-            safe_hps.update(node.alts)
-            if node.id in hps:
-                logging.warning('Found duplicate of HP term:' + node.id)
-
-            hps[node.id] = node
-            for alt_hp in node.alts:
-                if alt_hp in hps:
-                    logging.warning('Found duplicate of HP term:' + alt_hp)
-                else:
-                    hps[alt_hp] = node
-
-        # Reset all connections in network
-        for node in safe_nodes:
-            node.parents.clear()
-            node.children.clear()
-            node._parent_hps.intersection_update(safe_hps)
-            node._ancestors = None
-
-        # Re-link
-        for node in safe_nodes:
-            node.link(self.hps)
-
-        # Replace attributes
-        self.root = root
-        self.hps = hps
-        
+        root = self.term_index[root_hp]
+        keep = reachable(self.child_ptr, self.child_ids, root)
+        logging.info("Filtering to the {:d} nodes descendant of {} ({})...".format(len(keep), root_hp, self.term_names[root]))
+
+        self._build(self.term_ids, self.term_names, self.term_alts, self.parent_ptr, self.parent_ids,
+                    keep, root)
+
+    def _build(self, ids, names, alts, parent_ptr, parent_ids, keep, root):
+        """Number the kept terms and build the graph arrays
+
+        Args:
+            ids, names, alts: HP terms, names and alternate HP terms,
+                indexed by current integer id
+            parent_ptr, parent_ids: parents of each term, in CSR form
+            keep: current integer ids of the terms to keep (links to other
+                terms are dropped)
+            root: current integer id of the root, or None
+        """
+        # Number the root last, so it always ends an ancestor list
+        order = numpy.array(sorted(keep, key=lambda k: (k == root, ids[k])), dtype=numpy.int64)
+        num = len(order)
+        new_index = numpy.full(len(ids), -1, dtype=numpy.int32)
+        new_index[order] = numpy.arange(num)
+
+        self.term_ids = [ids[k] for k in order]
+        self.term_names = [names[k] for k in order]
+        self.term_alts = [alts[k] for k in order]
+        self.term_index = {}
+        for k, hp in enumerate(self.term_ids):
+            self.term_index[hp] = k
+            for alt in self.term_alts[k]:
+                self.term_index[alt] = k
+        self._root_index = None if root is None else int(new_index[root])
+
+        # Renumber the parents of kept terms, dropping the others
+        parent_ptr = numpy.asarray(parent_ptr, dtype=numpy.int64)
+        num_parents = parent_ptr[order + 1] - parent_ptr[order]
+        nodes = numpy.repeat(numpy.arange(num, dtype=numpy.int32), num_parents)
+        parents = new_index[numpy.asarray(parent_ids)[_gather_ranges(parent_ptr[order], num_parents)]]
+        nodes = nodes[parents >= 0]
+        parents = parents[parents >= 0]
+        self.parent_ptr = numpy.zeros(num + 1, dtype=numpy.int32)
+        self.parent_ptr[1:] = numpy.cumsum(numpy.bincount(nodes, minlength=num))
+        self.parent_ids = parents[numpy.lexsort((parents, nodes))]
+        self.child_ptr, self.child_ids = invert_adjacency(self.parent_ptr, self.parent_ids)
+
+        self._ancestors = None
+        self._descendants = None
+        self._nodes = [None] * num
+
+    @property
+    def hps(self):
+        return HPMapping(self)
+
+    @property
+    def root(self):
+        if self._root_index is None:
+            return None
+        return self._node(self._root_index)
+
+    def _get_ancestors(self):
+        if self._ancestors is None:
+            self._ancestors = ancestor_closure(self.parent_ptr, self.parent_ids)
+            logging.info("Found {:d} ancestor links for {:d} nodes".format(len(self._ancestors[1]), len(self)))
+        return self._ancestors
+
+    def _get_descendants(self):
+        if self._descendants is None:
+            self._descendants = invert_adjacency(*self._get_ancestors())
+        return self._descendants
+
+    @property
+    def ancestor_ptr(self):
+        return self._get_ancestors()[0]
+
+    @property
+    def ancestor_ids(self):
+        return self._get_ancestors()[1]
+
+    @property
+    def descendant_ptr(self):
+        return self._get_descendants()[0]
+
+    @property
+    def descendant_ids(self):
+        return self._get_descendants()[1]
+
+    def _node(self, k):
+        """Return the HP node for term k, creating it if needed"""
+        node = self._nodes[k]
+        if node is None:
+            node = self._nodes[k] = HP(self, k)
+        return node
+
+    def _nodes_in(self, ptr, ids, k):
+        """Return the tuple of nodes listed for term k in the given CSR arrays"""
+        return tuple(self._node(j) for j in ids[ptr[k]:ptr[k + 1]])
+
+    def random_ancestor(self, hp):
+        """Return a random ancestor of hp (possibly itself) other than the root
+
+        Raises KeyError if hp is not in the graph or is the root
+        """
+        k = self.term_index[hp]
+        start = self.ancestor_ptr[k]
+        end = self.ancestor_ptr[k + 1]
+        if self._root_index is not None and self.ancestor_ids[end - 1] == self._root_index:
+            end -= 1
+        if start == end:
+            raise KeyError(hp)
+        return self.term_ids[self.ancestor_ids[random.randrange(start, end)]]
+
+    def __getstate__(self):
+        # Nodes and closures are rebuilt on demand after unpickling
+        state = self.__dict__.copy()
+        state['_nodes'] = None
+        state['_ancestors'] = None
+        state['_descendants'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._nodes = [None] * len(self.term_ids)
+
     def __getitem__(self, key):
-        return self.hps[key]
+        return self._node(self.term_index[key])
+
+    def __contains__(self, key):
+        return key in self.term_index
 
     def __iter__(self):
-        return iter(set(self.hps.values()))
+        return (self._node(k) for k in range(len(self)))
 
     def __len__(self):
-        return len(set(self.hps.values()))
+        return len(self.term_ids)
+
+
+def _matrix_counts(hpo, matrix):
+    """Return the number of rows of an omim.PhenotypeMatrix (with only
+    terms in hpo, see filter_columns) having each term of hpo or one of its
+    descendants, and the number of rows with any term, as InformationContent
+    counts them"""
+    num = len(hpo)
+    column_ids = numpy.array([hpo.term_index[term] for term in matrix.terms], dtype=numpy.int64)
+    ids = column_ids[matrix.indices]
+    rows = numpy.repeat(numpy.arange(len(matrix), dtype=numpy.int64), numpy.diff(matrix.indptr))
+
+    # Every (row, ancestor) pair, once per row
+    ancestor_ptr = numpy.asarray(hpo.ancestor_ptr, dtype=numpy.int64)
+    lengths = ancestor_ptr[ids + 1] - ancestor_ptr[ids]
+    ancestors = numpy.asarray(hpo.ancestor_ids)[_gather_ranges(ancestor_ptr[ids], lengths)]
+    pairs = numpy.unique(numpy.repeat(rows, lengths) * num + ancestors)
+    return numpy.bincount(pairs % num, minlength=num), len(numpy.unique(pairs // num))
+
+class InformationContent(object):
+    """Information content (IC) of HPO terms, for phenotype similarity
+
+    The IC of a term is -log(p), where p is the fraction of annotated
+    diseases having the term or one of its descendants. Terms annotating
+    no disease get the IC of a term annotating one.
+
+    Terms are compared through their most informative common ancestor
+    (MICA). The ancestors of each term are kept as a bitset over all terms
+    ranked by decreasing IC, so the MICA of two terms is the lowest bit set
+    in both their bitsets. MICAs are cached by term pair.
+
+    Attributes:
+    hpo: HPO
+    num_diseases: number of diseases with at least one term in hpo
+    ic: array of the IC of each term, indexed by integer term id
+    """
+    def __init__(self, hpo, annotations):
+        """Compute the IC of terms in hpo
+
+        Args:
+            hpo: HPO
+            annotations: an omim.PhenotypeMatrix with only terms in hpo
+                (see filter_columns), or an iterable of collections of HP
+                terms, one per disease
+        """
+        self.hpo = hpo
+
+        if isinstance(annotations, PhenotypeMatrix):
+            counts, self.num_diseases = _matrix_counts(hpo, annotations)
+        else:
+            counts = array('i', [0]) * len(hpo)
+            self.num_diseases = 0
+            for terms in annotations:
+                closure = set()
+                for hp in terms:
+                    k = hpo.term_index.get(hp)
+                    if k is not None:
+                        closure.update(hpo.ancestor_ids[hpo.ancestor_ptr[k]:hpo.ancestor_ptr[k + 1]])
+                if closure:
+                    self.num_diseases += 1
+                    for k in closure:
+                        counts[k] += 1
+
+        num = float(self.num_diseases)
+        max_ic = math.log(num) if num else 0.0
+        self.ic = array('d', [math.log(num / count) if count else max_ic for count in counts])
+        logging.info("Computed IC of {:d} terms from {:d} diseases".format(len(counts), self.num_diseases))
+
+        # Ancestors never have a higher IC, so the lowest ranked common
+        # ancestor of two terms is their MICA
+        self._ranked = sorted(range(len(counts)), key=lambda k: (-self.ic[k], k))
+        self._rank = array('i', [0]) * len(counts)
+        for r, k in enumerate(self._ranked):
+            self._rank[k] = r
+
+        self._bitsets = {}
+        self._micas = {}
+
+    @classmethod
+    def from_annotations(cls, hpo, filename, db='OMIM'):
+        """Return the IC of terms in hpo from the diseases of the given
+        database in an annotation file (phenotype_annotation.tab)"""
+        mim = MIM(filename)
+        matrix = PhenotypeMatrix([disease for disease in mim if disease.db == db])
+        return cls(hpo, matrix.filter_columns(hpo.term_index))
+
+    def _ancestor_bits(self, k):
+        bits = self._bitsets.get(k)
+        if bits is None:
+            hpo = self.hpo
+            bits = 0
+            for j in hpo.ancestor_ids[hpo.ancestor_ptr[k]:hpo.ancestor_ptr[k + 1]]:
+                bits |= 1 << self._rank[j]
+            self._bitsets[k] = bits
+        return bits
+
+    def mica_index(self, j, k):
+        """Return the integer id of the MICA of terms j and k, or None if
+        they have no common ancestor"""
+        key = (j, k) if j <= k else (k, j)
+        try:
+            return self._micas[key]
+        except KeyError:
+            pass
+
+        common = self._ancestor_bits(j) & self._ancestor_bits(k)
+        if common:
+            mica = self._ranked[(common & -common).bit_length() - 1]
+        else:
+            mica = None
+        self._micas[key] = mica
+        return mica
+
+    def mica(self, hp1, hp2):
+        """Return the MICA of two HP terms (or None), raising KeyError if
+        either is not in the graph"""
+        term_index = self.hpo.term_index
+        mica = self.mica_index(term_index[hp1], term_index[hp2])
+        return None if mica is None else self.hpo.term_ids[mica]
+
+    def resnik(self, hp1, hp2):
+        """Return the Resnik similarity of two HP terms: the IC of their MICA"""
+        term_index = self.hpo.term_index
+        mica = self.mica_index(term_index[hp1], term_index[hp2])
+        return 0.0 if mica is None else self.ic[mica]
+
+    def lin(self, hp1, hp2):
+        """Return the Lin similarity of two HP terms: 2 IC(MICA) / (IC(hp1) + IC(hp2))"""
+        term_index = self.hpo.term_index
+        j = term_index[hp1]
+        k = term_index[hp2]
+        total = self.ic[j] + self.ic[k]
+        mica = self.mica_index(j, k)
+        if mica is None or not total:
+            return 0.0
+        return 2 * self.ic[mica] / total
 
 
 def script(hpo_filename):
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Progress manifest of a patient generation run, listing the samples which
+are complete (with their seeds and output files), so an interrupted run
+can be resumed without redoing them.
+"""
+
+
+import os
+import sys
+import json
+import logging
+
+
+__author__ = 'Tal Friedman (talf301@gmail.com)'
+
+MANIFEST_FILENAME = 'manifest.txt'
+SEED_PREFIX = '#seed='
+OPTIONS_PREFIX = '#options='
+
+class ManifestError(Exception):
+    pass
+
+class Manifest:
+    """Completed samples of a run, appended to a file in chunks
+
+    The file has a header with the master seed and run options, then
+    one tab-separated line per completed sample: index, seed of the
+    sample and comma-separated output files.
+
+    Attributes:
+    filename: path of the manifest file
+    seed: master seed of the run
+    options: dict of run options, which must match to resume
+    done: set of indices of completed samples
+    chunk_size: number of completed samples to buffer before writing
+    """
+    def __init__(self, filename, seed, options, chunk_size=100):
+        self.filename = filename
+        self.seed = seed
+        self.options = options
+        self.done = set()
+        self.chunk_size = chunk_size
+        self._pending = []
+
+    @classmethod
+    def create(cls, out_path, seed, options, chunk_size=100):
+        """Start a new manifest in out_path, replacing any existing one"""
+        filename = os.path.join(out_path, MANIFEST_FILENAME)
+        if os.path.exists(filename):
+            logging.warning("Replacing manifest of previous run: %s" % filename)
+
+        manifest = cls(filename, seed, options, chunk_size)
+        with open(filename, 'w') as ofp:
+            ofp.write(SEED_PREFIX + str(seed) + '\n')
+            ofp.write(OPTIONS_PREFIX + json.dumps(options, sort_keys=True) + '\n')
+        return manifest
+
+    @classmethod
+    def resume(cls, out_path, options, seed=None, chunk_size=100):
+        """Load the manifest in out_path to carry on its run
+
+        Raises ManifestError if there is no manifest, or if it was written
+        by a run with a different seed (if given) or options
+        """
+        filename = os.path.join(out_path, MANIFEST_FILENAME)
+        if not os.path.isfile(filename):
+            raise ManifestError("No manifest to resume from: %s" % filename)
+
+        with open(filename) as ifp:
+            run_seed = int(ifp.readline()[len(SEED_PREFIX):])
+            run_options = json.loads(ifp.readline()[len(OPTIONS_PREFIX):])
+            if seed is not None and seed != run_seed:
+                raise ManifestError("Seed %d does not match seed %d of run to resume"
+                        % (seed, run_seed))
+            if run_options != json.loads(json.dumps(options)):
+                raise ManifestError("Options do not match those of run to resume: %s"
+                        % run_options)
+
+            manifest = cls(filename, run_seed, run_options, chunk_size)
+            end = ifp.tell()
+            for line in iter(ifp.readline, ''):
+                # Stop at a partially written last line
+                if not line.endswith('\n'):
+                    break
+                manifest.done.add(int(line.split('\t', 1)[0]))
+                end += len(line)
+
+        # Drop any partial line, so new lines are appended cleanly
+        if os.path.getsize(filename) > end:
+            with open(filename, 'r+b') as ofp:
+                ofp.truncate(end)
+
+        logging.info("Resuming run with %d samples done" % len(manifest.done))
+        return manifest
+
+    def add(self, i, seed, files):
+        """Record that sample i (with the given seed) wrote the given files"""
+        self.done.add(i)
+        self._pending.append('%d\t%d\t%s\n' % (i, seed, ','.join(files)))
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write out all recorded samples"""
+        if self._pending:
+            with open(self.filename, 'a') as ofp:
+                ofp.writelines(self._pending)
+                ofp.flush()
+                os.fsync(ofp.fileno())
+            self._pending = []
@@ -3,6 +3,8 @@ import sys
 import re
 import logging
 
+import numpy
+
 from collections import defaultdict
 
 FREQUENCIES = {'very rare':  0.01, 
@@ -24,13 +26,144 @@ class Disease:
         self.name = name
         self.phenotype_freqs = phenotype_freqs
 
-class MIM:
-    def __init__(self, filename):
-        self.diseases = list(self.iter_diseases(filename))
+class PhenotypeMatrix(object):
+    """Phenotype frequencies of diseases as a sparse (CSR) matrix
+
+    Rows are diseases and columns are HPO terms, in sorted order, so the
+    terms of each row are sorted. The entries of row k are the positions
+    indptr[k]:indptr[k + 1] of indices, freqs and entry_terms.
+
+    Attributes:
+    keys: list of (db, id) of each row
+    row_index: {(db, id) -> row}
+    terms: list of HPO terms of each column
+    term_index: {HPO term -> column}
+    indptr, indices: numpy arrays of the CSR structure
+    freqs: numpy array of frequencies, 0 where none was given
+    entry_terms: numpy object array of the HPO term of each entry
+    """
+    def __init__(self, diseases):
+        """Build the matrix from a list of Disease objects"""
+        self.keys = [(disease.db, disease.id) for disease in diseases]
+        self.row_index = dict((key, k) for k, key in enumerate(self.keys))
+        self.terms = sorted(set(term for disease in diseases for term in disease.phenotype_freqs))
+        self.term_index = dict((term, k) for k, term in enumerate(self.terms))
+
+        indptr = [0]
+        indices = []
+        freqs = []
+        for disease in diseases:
+            for column, freq in sorted((self.term_index[term], freq)
+                                       for term, freq in disease.phenotype_freqs.iteritems()):
+                indices.append(column)
+                freqs.append(freq)
+            indptr.append(len(indices))
+
+        self.indptr = numpy.array(indptr, dtype=numpy.int64)
+        self.indices = numpy.array(indices, dtype=numpy.int32)
+        self.freqs = numpy.array([freq or 0.0 for freq in freqs], dtype=numpy.float64)
+        self.entry_terms = numpy.array(self.terms, dtype=object)[self.indices]
+        self._probabilities = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def filter_columns(self, terms):
+        """Drop all entries and columns for HPO terms not in the given
+        container (e.g. hp.term_index), returning self"""
+        keep = numpy.array([term in terms for term in self.terms], dtype=bool)
+        mask = keep[self.indices] if len(self.indices) else numpy.zeros(0, dtype=bool)
+        kept = numpy.concatenate([[0], numpy.cumsum(mask)])
+        logging.info("Dropped %d of %d phenotype annotations" % (len(mask) - kept[-1], len(mask)))
+
+        # Renumber the remaining columns, which keeps them in sorted order
+        columns = numpy.cumsum(keep) - 1
+        self.terms = [term for term, kept_term in zip(self.terms, keep) if kept_term]
+        self.term_index = dict((term, k) for k, term in enumerate(self.terms))
+        self.indptr = kept[self.indptr]
+        self.indices = columns[self.indices[mask]].astype(numpy.int32)
+        self.freqs = self.freqs[mask]
+        self.entry_terms = self.entry_terms[mask]
+        self._probabilities = None
+        return self
+
+    def row_terms(self, k):
+        """Return the list of HPO terms of row k"""
+        return self.entry_terms[self.indptr[k]:self.indptr[k + 1]].tolist()
+
+    def probabilities(self, default_freq):
+        """Return the array of the frequency of each entry, with
+        default_freq where none (or 0) was given, as sampled by
+        generate_patient_pairs. The last array is cached."""
+        if self._probabilities is None or self._probabilities[0] != default_freq:
+            self._probabilities = (default_freq,
+                    numpy.where(self.freqs != 0, self.freqs, default_freq))
+        return self._probabilities[1]
+
+class MIM(object):
+    """Diseases of a phenotype annotation file, indexed by (db, id)
+
+    In lazy mode, only the byte range of each disease's block of lines is
+    recorded up front, and a disease is parsed when it is first looked up.
+
+    Attributes:
+    filename: phenotype annotation file
+    lazy: whether diseases are parsed on demand
+    diseases: list of Disease objects, in file order (parses all diseases
+        in lazy mode)
+    """
+    def __init__(self, filename, lazy=False):
+        self.filename = filename
+        self.lazy = lazy
+        # (db, id) -> Disease, or -> (start, end) byte offsets in lazy mode
+        self.index = {}
+        self._keys = []
+        self._diseases = None
+
+        if lazy:
+            for disease, start, end in self.iter_disease_offsets(filename):
+                self._add(disease, (start, end))
+        else:
+            self._diseases = list(self.iter_diseases(filename))
+            for disease in self._diseases:
+                self._add((disease.db, disease.id), disease)
+
+    def _add(self, key, value):
+        if key in self.index:
+            logging.warning("Ignoring repeated block of lines for %s:%s" % key)
+        else:
+            self.index[key] = value
+            self._keys.append(key)
+
+    @property
+    def diseases(self):
+        if self._diseases is None:
+            self._diseases = [self[key] for key in self._keys]
+        return self._diseases
 
     def __iter__(self):
         return iter(self.diseases)
 
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        """Return whether there is a disease with the given (db, id)"""
+        return key in self.index
+
+    def __getitem__(self, key):
+        """Return the Disease with the given (db, id), raising KeyError if absent"""
+        value = self.index[key]
+        if isinstance(value, tuple):
+            start, end = value
+            with open(self.filename) as ifp:
+                ifp.seek(start)
+                lines = ifp.read(end - start).splitlines()
+            tokens_list = [line.rstrip().split('\t') for line in lines]
+            value = self.parse_disease(key, [tokens for tokens in tokens_list if len(tokens) > 1])
+            self.index[key] = value
+        return value
+
     @classmethod
     def iter_disease_lines(cls, filename):
         with open(filename) as ifp:
@@ -52,6 +185,28 @@ class MIM:
                     cur_disease = disease
             if cur_disease:
                 yield cur_disease, cur_lines
+
+    @classmethod
+    def iter_disease_offsets(cls, filename):
+        """Yield ((db, id), start, end) byte offsets of each block of lines
+        for a disease, without parsing the lines"""
+        with open(filename) as ifp:
+            cur_disease = None
+            start = end = 0
+            offset = 0
+            for line in iter(ifp.readline, ''):
+                tokens = line.split('\t', 2)
+                if len(tokens) > 1:
+                    disease = (tokens[0].strip(), tokens[1].strip())
+                    if disease != cur_disease:
+                        if cur_disease:
+                            yield cur_disease, start, end
+                        cur_disease = disease
+                        start = offset
+                    end = offset + len(line)
+                offset += len(line)
+            if cur_disease:
+                yield cur_disease, start, end
     
     @classmethod
     def parse_frequency(cls, s, default=None):
@@ -80,34 +235,39 @@ class MIM:
 
         return freq
 
+    @classmethod
+    def parse_disease(cls, disease, tokens_list, default_freq=None):
+        """Return the Disease for the given (db, id) and its lines, split into tokens"""
+        db, id = disease
+        raw_phenotypes = defaultdict(list)
+        name = None
+        for tokens in tokens_list:
+            freq = cls.parse_frequency(tokens[8])
+            hp_term = tokens[4].strip()
+            raw_phenotypes[hp_term].append(freq)
+            if not name:
+                name = tokens[2].strip()
+
+        phenotype_freqs = {}
+        for hp_term, freqs in raw_phenotypes.items():
+            non_null = [x for x in freqs if x is not None]
+            if non_null:
+                freq = sum(non_null) / len(non_null)
+            else:
+                freq = default_freq
+
+            phenotype_freqs[hp_term] = freq
+
+        return Disease(db, id, name, phenotype_freqs)
+
     @classmethod
     def iter_diseases(cls, filename, default_freq=None):
         counter = 0
         for disease, tokens_list in cls.iter_disease_lines(filename):
-            db, id = disease
-            raw_phenotypes = defaultdict(list)
-            name = None
-            for tokens in tokens_list:
-                freq = cls.parse_frequency(tokens[8])
-                hp_term = tokens[4].strip()
-                raw_phenotypes[hp_term].append(freq)
-                if not name:
-                    name = tokens[2].strip()
-
-            phenotype_freqs = {}
-            for hp_term, freqs in raw_phenotypes.items():
-                non_null = [x for x in freqs if x is not None]
-                if non_null:
-                    freq = sum(non_null) / len(non_null)
-                else:
-                    freq = default_freq
-
-                phenotype_freqs[hp_term] = freq
-            
-            if all(not freq for freq in phenotype_freqs.itervalues()) and db == 'OMIM':
+            disease = cls.parse_disease(disease, tokens_list, default_freq)
+            if all(not freq for freq in disease.phenotype_freqs.itervalues()) and disease.db == 'OMIM':
                 counter += 1
 
-            disease = Disease(db, id, name, phenotype_freqs)
             yield disease
         
         logging.warning("%d OMIM diseases had no freq info at all" % counter)
@@ -12,7 +12,10 @@ import sys
 import logging
 
 from collections import defaultdict
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 
 __author__ = 'Tal Friedman (talf301@gmail.com)'
@@ -23,12 +26,91 @@ class Disease:
         self.inheritance = []
         self.geno = []
 
-class Orphanet:
+def iter_disorders(filename):
+    """Yield each Disorder element of an Orphanet XML file as it is parsed
+
+    Disorders are yielded once complete (nested ones before the disorder
+    containing them). Each outermost disorder is cleared and dropped from
+    the tree once consumed, so the whole document is never held in memory.
+    """
+    stack = []
+    num_disorders = 0
+    for event, elem in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'Disorder':
+                num_disorders += 1
+            continue
+
+        stack.pop()
+        if elem.tag != 'Disorder':
+            continue
+
+        yield elem
+        num_disorders -= 1
+        if num_disorders == 0:
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+
+INHERITANCE_PATTERNS = ['X-linked dominant', 'Mitochondrial inheritance', \
+        'Unknown', 'Autosomal recessive', 'Multigenic/multifactorial', \
+        'X-linked recessive', 'Sporadic', 'Autosomal dominant', \
+        'No data available']
+
+def read_lookup(filename):
+    """Return the Orphanet # -> Disease dict of the phenotypic omim reference
+    file (see Orphanet.parse_lookup)"""
+    return Orphanet.parse_lookup(filename)
+
+def read_inheritance(filename):
+    """Return a list of (Orphanet #, list of inheritance pattern names) for
+    the disorders in the inheritance reference file"""
+    inheritance = []
+    for disorder in iter_disorders(filename):
+        orphanum = disorder.find('OrphaNumber').text
+        patterns = [inher.find('Name').text for inher in
+                disorder.findall('./TypeOfInheritanceList/TypeOfInheritance')]
+        inheritance.append((orphanum, patterns))
+    return inheritance
+
+def read_geno_pheno(filename):
+    """Return a list of (Orphanet #, list of genotypic OMIM numbers) for the
+    disorders in the genotypic omim reference file"""
+    geno_pheno = []
+    for disorder in iter_disorders(filename):
+        orphanum = disorder.find('OrphaNumber').text
+        omims = []
+        for ref in disorder.findall('.//ExternalReferenceList/ExternalReference'):
+            if ref.find('Source').text == 'OMIM':
+                omim = ref.find('Reference').text
+                # Ensure OMIM is numeric
+                try:
+                    int(omim)
+                except ValueError:
+                    logging.error("Malformed OMIM %s" % omim)
+                omims.append(omim)
+        geno_pheno.append((orphanum, omims))
+    return geno_pheno
+
+class Orphanet(object):
     def __init__(self, lookup_filename, inher_filename, geno_pheno_filename):
-        self.lookup = self.parse_lookup(lookup_filename)
-        self.inheritance = self.parse_inheritance(inher_filename, self.lookup)
+        self.merge(self.parse_lookup(lookup_filename), read_inheritance(inher_filename),
+                read_geno_pheno(geno_pheno_filename))
+
+    @classmethod
+    def from_parsed(cls, lookup, inheritance, geno_pheno):
+        """Return an Orphanet from the results of read_lookup,
+        read_inheritance and read_geno_pheno, e.g. run in parallel"""
+        orph = cls.__new__(cls)
+        orph.merge(lookup, inheritance, geno_pheno)
+        return orph
+
+    def merge(self, lookup, inheritance, geno_pheno):
+        self.lookup = lookup
+        self.inheritance = self.add_inheritance(self.lookup, inheritance)
         # Counter for when we write stats
-        self.counter = self.parse_geno_pheno(geno_pheno_filename,self.lookup)
+        self.counter = self.add_geno_pheno(self.lookup, geno_pheno)
     
     @classmethod
     def parse_lookup(cls, filename):
@@ -42,11 +124,9 @@ class Orphanet:
             Orphanet # -> Disease dict, with each entry having nonempty
             pheno and empty inheritance and geno
         """
-        tree = ET.parse(filename)
-        root = tree.getroot()
         lookup = defaultdict(Disease) # orphanet -> omim
         counter = 0
-        for disorder in root.findall('.//Disorder'):
+        for disorder in iter_disorders(filename):
             orphanum = disorder.find('OrphaNumber').text
             for ref in disorder.findall('./ExternalReferenceList/ExternalReference'):
                 if ref.find('Source').text == 'OMIM':
@@ -72,20 +152,17 @@ class Orphanet:
             lookup: Orphanet # -> Disease dict, expect each pheno entry
             to be nonempty
         """
-        tree = ET.parse(filename)
-        root = tree.getroot()
-        counter = 0
-        for disorder in root.findall('.//Disorder'):
-            orphanum = disorder.find('OrphaNumber').text
+        return cls.add_inheritance(lookup, read_inheritance(filename))
 
+    @classmethod
+    def add_inheritance(cls, lookup, inheritance):
+        """Add inheritance patterns (from read_inheritance) to the diseases in lookup"""
+        counter = 0
+        for orphanum, patterns in inheritance:
             # Ensure that this disorder has an omim number
             if orphanum in lookup:
-                for inher in  disorder.findall('./TypeOfInheritanceList/TypeOfInheritance'):
-                    pattern = inher.find('Name').text
-                    assert pattern in ['X-linked dominant', 'Mitochondrial inheritance', \
-                            'Unknown', 'Autosomal recessive', 'Multigenic/multifactorial', \
-                            'X-linked recessive', 'Sporadic', 'Autosomal dominant', \
-                            'No data available'], "Unrecognized inheritance pattern %s" % pattern
+                for pattern in patterns:
+                    assert pattern in INHERITANCE_PATTERNS, "Unrecognized inheritance pattern %s" % pattern
                     lookup[orphanum].inheritance.append(pattern)
             else:
                 counter += 1
@@ -106,29 +183,20 @@ class Orphanet:
             A count of the number of orphanet diseases found in this file without a 
             genotypic mapping.
         """
-        tree = ET.parse(filename)
-        root = tree.getroot()
-        counter = 0
-        for disorder in root.findall('.//Disorder'):
-            restart = False
-            orphanum = disorder.find('OrphaNumber').text
-            for ref in disorder.findall('.//ExternalReferenceList/ExternalReference'):
-                if ref.find('Source').text == 'OMIM':
-                    omim = ref.find('Reference').text
-                    # Ensure OMIM is numeric
-                    try:
-                        int(omim)
-                    except ValueError:
-                        logging.error("Malformed OMIM %s" % omim)
+        return cls.add_geno_pheno(lookup, read_geno_pheno(filename))
 
-                    try:
-                        lookup[orphanum].geno.append(omim)           
-                    except KeyError:
-                        restart = True
-                        counter += 1
-                        break
-            if restart:
-                continue
+    @classmethod
+    def add_geno_pheno(cls, lookup, geno_pheno):
+        """Add genotypic OMIMs (from read_geno_pheno) to the diseases in lookup,
+        returning the number of disorders without a phenotypic mapping"""
+        counter = 0
+        for orphanum, omims in geno_pheno:
+            for omim in omims:
+                try:
+                    lookup[orphanum].geno.append(omim)
+                except KeyError:
+                    counter += 1
+                    break
         logging.warning("%d Disorders were unmatched to a phenotypic omim" % counter)
         return counter
 
@@ -180,6 +248,16 @@ class Orphanet:
         """Return if disease has HPO terms associated with it""" 
         return dis.pheno[0] in omim_dict
 
+    @classmethod
+    def get_by_geno(cls, lookup):
+        """Return a dict of genotypic OMIM number -> sorted list of the Orphanet
+        numbers of the diseases in lookup with that genotypic OMIM"""
+        by_geno = {}
+        for orphanum in sorted(lookup):
+            for omim in lookup[orphanum].geno:
+                by_geno.setdefault(omim, []).append(orphanum)
+        return by_geno
+
     @classmethod
     def filter_lookup(cls, lookup, omim_dict, rev_hgmd, Inheritance=None):
         """Return a new lookup table filtered based on inheritance and mapping ability
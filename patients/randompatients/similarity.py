@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+Score every generated patient against every other by phenotype similarity,
+writing the top matches of each patient in the format read by
+analysis/phenotype_score.py (patient, match, score; tab-separated).
+
+Each patient is a row of a sparse patients x HPO terms matrix holding the
+ancestor closure of its phenotypes (from PATIENT_hpo.txt), and similarities
+are computed a block of patients at a time with sparse matrix products.
+For large cohorts, --lsh only scores the candidate pairs proposed by
+MinHash locality-sensitive hashing.
+"""
+
+
+import os
+import sys
+import logging
+
+import numpy
+import scipy.sparse
+
+import hpo
+
+from argparse import ArgumentParser
+
+
+__author__ = 'Tal Friedman (talf301@gmail.com)'
+
+HPO_SUFFIX = '_hpo.txt'
+METRICS = ['simgic', 'cosine']
+
+def read_patients(hpo_path):
+    """Return (list of patient names, list of lists of HP terms) for the
+    PATIENT_hpo.txt files in hpo_path, sorted by name"""
+    names = []
+    phenotypes = []
+    for filename in sorted(os.listdir(hpo_path)):
+        if not filename.endswith(HPO_SUFFIX):
+            continue
+        with open(os.path.join(hpo_path, filename)) as ifp:
+            terms = ifp.read().strip()
+        names.append(filename[:-len(HPO_SUFFIX)])
+        phenotypes.append(terms.split(',') if terms else [])
+    return names, phenotypes
+
+def patient_matrix(hp, phenotypes):
+    """Return the binary patients x terms CSR matrix of the ancestor closures
+    of the given phenotypes (terms not in hp are ignored)"""
+    indptr = [0]
+    indices = []
+    num_unknown = 0
+    for terms in phenotypes:
+        closure = set()
+        for term in terms:
+            k = hp.term_index.get(term)
+            if k is None:
+                num_unknown += 1
+                continue
+            closure.update(hp.ancestor_ids[hp.ancestor_ptr[k]:hp.ancestor_ptr[k + 1]])
+        indices.extend(sorted(closure))
+        indptr.append(len(indices))
+
+    if num_unknown:
+        logging.warning("Ignored %d phenotypes not in HPO" % num_unknown)
+    data = numpy.ones(len(indices))
+    return scipy.sparse.csr_matrix((data, numpy.array(indices, dtype=numpy.int32), indptr),
+            shape=(len(phenotypes), len(hp)))
+
+def weigh(matrix, ic, metric='simgic'):
+    """Return (weighted, other, totals) for scoring patients
+
+    The dot product of a row of weighted with a row of other is the
+    unnormalized similarity of the two patients. totals is the IC of all
+    terms of each patient for simgic, and None for cosine.
+
+    Args:
+        matrix: binary patients x terms CSR matrix, from patient_matrix
+        ic: sequence of the information content of each term
+        metric: 'simgic' (IC of shared terms over IC of all terms of the
+            pair) or 'cosine' (of the IC-weighted term vectors)
+    """
+    weighted = scipy.sparse.csr_matrix(matrix.multiply(numpy.asarray(ic)))
+    if metric == 'simgic':
+        return weighted, matrix, numpy.asarray(weighted.sum(axis=1)).ravel()
+    elif metric == 'cosine':
+        norms = numpy.sqrt(numpy.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        weighted = scipy.sparse.csr_matrix(weighted.multiply(1 / norms[:, numpy.newaxis]))
+        return weighted, weighted, None
+    else:
+        raise ValueError("Unknown metric: %s" % metric)
+
+def normalize(common, row_totals, col_totals):
+    """Return simGIC scores from the IC shared by each pair and their totals"""
+    if row_totals is None:
+        return common
+    union = row_totals + col_totals - common
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(union > 0, common / union, 0.0)
+
+def similarity_blocks(matrix, ic, metric='simgic', block_size=256, rows=None):
+    """Compute patient similarities a block of rows at a time
+
+    Args:
+        matrix: binary patients x terms CSR matrix, from patient_matrix
+        ic: sequence of the information content of each term
+        metric: 'simgic' or 'cosine', as for weigh
+        block_size: number of patients per block
+        rows: array of the rows to score (default is all)
+
+    Yields:
+        (array of rows, dense rows x patients array of similarities)
+
+    Memory use is dominated by the dense blocks, of block_size x terms and
+    block_size x patients.
+    """
+    weighted, other, totals = weigh(matrix, ic, metric)
+    if rows is None:
+        rows = numpy.arange(matrix.shape[0])
+
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        # The products are nearly dense, so multiply the sparse matrix by
+        # a dense block rather than forming a sparse result
+        dense = weighted[block_rows].toarray()
+        block = numpy.ascontiguousarray(other.dot(dense.T).T)
+        if totals is not None:
+            block = normalize(block, totals[block_rows, numpy.newaxis], totals)
+        yield block_rows, block
+
+def top_k(scores, k):
+    """Return the indices of the k highest scores, highest first (ties by index)"""
+    if k <= 0:
+        return numpy.arange(0)
+    if k < len(scores):
+        candidates = numpy.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = numpy.arange(len(scores))
+    return candidates[numpy.lexsort((candidates, -scores[candidates]))]
+
+def top_matches(matrix, ic, k, metric='simgic', block_size=256, rows=None):
+    """Yield (patient row, list of (match row, score)) of the k best matches
+    of each patient with any phenotypes (of the given rows), best first"""
+    empty = numpy.diff(matrix.indptr) == 0
+    for block_rows, block in similarity_blocks(matrix, ic, metric, block_size, rows):
+        for i, scores in zip(block_rows, block):
+            if empty[i]:
+                continue
+            # Never match a patient to itself or to patients without phenotypes
+            scores[i] = -numpy.inf
+            scores[empty] = -numpy.inf
+            num = min(k, len(scores) - 1 - int(empty.sum()))
+            yield i, [(j, scores[j]) for j in top_k(scores, num)]
+
+def minhash_signatures(matrix, num_hashes=64, seed=0, chunk_size=10000):
+    """Return the patients x num_hashes array of MinHash signatures of the
+    term sets of patients
+
+    Each hash is a random permutation of the terms, and a patient's value
+    is the lowest rank of its terms, so two patients agree on a hash with
+    probability equal to the Jaccard similarity of their term sets.
+    Patients without terms get the number of terms for every hash.
+    """
+    num_terms = matrix.shape[1]
+    random_state = numpy.random.RandomState(seed)
+    perms = numpy.array([random_state.permutation(num_terms) for h in range(num_hashes)],
+            dtype=numpy.int32)
+
+    signatures = numpy.empty((matrix.shape[0], num_hashes), dtype=numpy.int32)
+    signatures.fill(num_terms)
+    for start in range(0, matrix.shape[0], chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        rows = numpy.flatnonzero(numpy.diff(chunk.indptr))
+        if len(rows) == 0:
+            continue
+        ranks = perms[:, chunk.indices]
+        # Empty rows add no segments, so reduce from the start of each other row
+        mins = numpy.minimum.reduceat(ranks, chunk.indptr[rows], axis=1)
+        signatures[start + rows] = mins.T
+    return signatures
+
+class LSHIndex:
+    """Buckets of patients whose MinHash signatures agree on a band
+
+    The signature is split into bands, and patients are candidates for
+    each other if they agree on every hash of any one band. Patients
+    with Jaccard similarity s are candidates with probability
+    1 - (1 - s^r)^b, for b bands of r hashes.
+
+    Attributes:
+    bucket_ids: list of arrays, one per band, of the bucket of each patient
+    members: list of arrays, one per band, of patients ordered by bucket
+    starts: list of arrays, one per band, of the offset in members of each bucket
+    """
+    def __init__(self, signatures, bands):
+        num_hashes = signatures.shape[1]
+        assert num_hashes % bands == 0, "Number of hashes must be a multiple of bands"
+        width = num_hashes // bands
+
+        self.bucket_ids = []
+        self.members = []
+        self.starts = []
+        for b in range(bands):
+            band = numpy.ascontiguousarray(signatures[:, b * width:(b + 1) * width])
+            keys = band.view(numpy.dtype((numpy.void, band.dtype.itemsize * width))).ravel()
+            unique, bucket_ids = numpy.unique(keys, return_inverse=True)
+            self.bucket_ids.append(bucket_ids)
+            self.members.append(numpy.argsort(bucket_ids, kind='mergesort'))
+            self.starts.append(numpy.searchsorted(bucket_ids[self.members[-1]],
+                    numpy.arange(len(unique) + 1)))
+
+    def candidates(self, i):
+        """Return the sorted array of patients sharing a bucket with patient i"""
+        found = []
+        for bucket_ids, members, starts in zip(self.bucket_ids, self.members, self.starts):
+            bucket = bucket_ids[i]
+            found.append(members[starts[bucket]:starts[bucket + 1]])
+        return numpy.unique(numpy.concatenate(found))
+
+def candidate_matches(matrix, ic, k, metric='simgic', num_hashes=64, bands=16, seed=0,
+                      block_size=256):
+    """Yield (patient row, list of (match row, score)) of the k best matches
+    of each patient with any phenotypes, best first, like top_matches, but
+    only scoring the candidates proposed by MinHash LSH"""
+    weighted, other, totals = weigh(matrix, ic, metric)
+    empty = numpy.diff(matrix.indptr) == 0
+    index = LSHIndex(minhash_signatures(matrix, num_hashes, seed), bands)
+
+    rows = numpy.flatnonzero(~empty)
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        candidates = []
+        for i in block_rows:
+            found = index.candidates(i)
+            candidates.append(found[(found != i) & ~empty[found]])
+
+        # Score the block against all of its candidates at once
+        union = numpy.unique(numpy.concatenate(candidates))
+        common = other[union].dot(weighted[block_rows].toarray().T)
+        for r, i in enumerate(block_rows):
+            found = candidates[r]
+            scores = common[numpy.searchsorted(union, found), r]
+            if totals is not None:
+                scores = normalize(scores, totals[i], totals[found])
+            yield i, [(found[j], scores[j]) for j in top_k(scores, min(k, len(scores)))]
+
+def recall(matrix, ic, matches, k, metric='simgic', sample=1000, seed=0):
+    """Return (fraction of the exact top k matches of a random sample of
+    patients which are among their given matches, size of the sample)
+
+    Args:
+        matches: {patient row -> list of (match row, score)}, e.g. from
+            candidate_matches
+    """
+    rows = numpy.flatnonzero(numpy.diff(matrix.indptr))
+    if sample < len(rows):
+        rows = numpy.sort(numpy.random.RandomState(seed).choice(rows, sample, replace=False))
+
+    num_exact = 0
+    num_found = 0
+    for i, exact in top_matches(matrix, ic, k, metric, rows=rows):
+        found = set(j for j, score in matches.get(i, []))
+        num_exact += len(exact)
+        num_found += sum(1 for j, score in exact if j in found)
+    return (float(num_found) / num_exact if num_exact else 1.0), len(rows)
+
+def script(data_path, hpo_path, out_file, top, metric, block_size, lsh=False,
+           num_hashes=64, bands=16, recall_sample=0, seed=0, **kwargs):
+    hp = hpo.HPO(os.path.join(data_path, 'hp.obo'))
+    hp.filter_to_descendants('HP:0000118')
+    ic = hpo.InformationContent.from_annotations(hp, os.path.join(data_path, 'phenotype_annotation.tab'))
+
+    names, phenotypes = read_patients(hpo_path)
+    logging.info("Scoring %d patients" % len(names))
+    matrix = patient_matrix(hp, phenotypes)
+
+    if lsh:
+        matches = candidate_matches(matrix, ic.ic, top, metric, num_hashes, bands, seed, block_size)
+    else:
+        matches = top_matches(matrix, ic.ic, top, metric, block_size)
+
+    found = {}
+    with open(out_file, 'w') as ofp:
+        for i, patient_matches in matches:
+            if recall_sample:
+                found[i] = patient_matches
+            for j, score in patient_matches:
+                ofp.write('%s\t%s\t%.6f\n' % (names[i], names[j], score))
+
+    if recall_sample:
+        fraction, num = recall(matrix, ic.ic, found, top, metric, recall_sample, seed)
+        logging.info("Recall of exact top %d matches on %d sampled patients: %.4f"
+                % (top, num, fraction))
+
+def parse_args(args):
+    parser = ArgumentParser(description=__doc__.strip())
+
+    parser.add_argument('hpo_path', metavar='DIR',
+            help='Directory of generated PATIENT_hpo.txt files')
+    parser.add_argument('--data_path', '-d', metavar='DATA', required=True,
+            help='Directory with hp.obo and phenotype_annotation.tab')
+    parser.add_argument('--out_file', '-o', metavar='OUT', required=True,
+            help='File to write the top matches of each patient to')
+    parser.add_argument('--top', '-k', type=int, default=10,
+            help='Number of matches to write per patient (default is 10)')
+    parser.add_argument('--metric', default='simgic', choices=METRICS,
+            help='Similarity of two patients (default is simgic)')
+    parser.add_argument('--block_size', type=int, default=256,
+            help='Number of patients to score at a time, which bounds memory'
+            ' use to about 8 * block_size * (patients + terms) bytes (default is 256)')
+    parser.add_argument('--lsh', action='store_true',
+            help='Only score candidate pairs proposed by MinHash LSH over the'
+            ' patients\' ancestor-closed terms, instead of all pairs')
+    parser.add_argument('--num_hashes', type=int, default=64,
+            help='Number of MinHash hashes per patient (default is 64)')
+    parser.add_argument('--bands', type=int, default=16,
+            help='Number of LSH bands the hashes are split into. More bands'
+            ' propose more candidates, for higher recall (default is 16)')
+    parser.add_argument('--recall_sample', type=int, default=0, metavar='NUM',
+            help='Log the recall of the exact top matches of NUM random'
+            ' patients among those written')
+    parser.add_argument('--seed', type=int, default=0,
+            help='Random seed for the MinHash hashes and recall sample')
+    parser.add_argument('--logging', default='INFO',
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            help='Logging level')
+    return parser.parse_args(args)
+
+def main(args = sys.argv[1:]):
+    args = parse_args(args)
+    logging.basicConfig(level=args.logging)
+    script(**vars(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Compile the parsed and filtered knowledge base (HGMD, HPO, OMIM and Orphanet)
+in a data directory into a single snapshot file, so that patient generation
+can skip re-parsing the source files, along with the table of diseases
+eligible for sampling under each set of options. A snapshot is only used
+while the source files it was compiled from are unchanged.
+"""
+
+
+import os
+import sys
+import hashlib
+import logging
+import cPickle as pickle
+
+from argparse import ArgumentParser
+
+
+__author__ = 'Tal Friedman (talf301@gmail.com)'
+
+# Bump whenever the pickled structures change incompatibly
+SNAPSHOT_VERSION = 9
+SNAPSHOT_FILENAME = 'knowledge.snapshot'
+ELIGIBLE_FILENAME = 'eligible.snapshot'
+SOURCE_FILENAMES = ['hgmd_correct.jv.vcf', 'hp.obo', 'phenotype_annotation.tab',
+        'orphanet_lookup.xml', 'orphanet_inher.xml', 'orphanet_geno_pheno.xml']
+
+def file_md5(filename):
+    """Return the hex md5 digest of the given file"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as ifp:
+        for chunk in iter(lambda: ifp.read(1 << 20), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def source_signatures(data_path, checksum=True):
+    """Return {filename -> (size, mtime, md5)} for the source files in data_path
+
+    md5 is None unless checksum is True
+    """
+    signatures = {}
+    for filename in SOURCE_FILENAMES:
+        path = os.path.join(data_path, filename)
+        stat = os.stat(path)
+        md5 = file_md5(path) if checksum else None
+        signatures[filename] = (stat.st_size, stat.st_mtime, md5)
+    return signatures
+
+def is_fresh(data_path, signatures):
+    """Return whether the source files in data_path match the given signatures
+
+    Files whose size and mtime are unchanged are trusted, otherwise the
+    file is checksummed, so a touched but identical file is still fresh.
+    """
+    for filename in SOURCE_FILENAMES:
+        path = os.path.join(data_path, filename)
+        try:
+            size, mtime, md5 = signatures[filename]
+            stat = os.stat(path)
+        except (KeyError, OSError):
+            return False
+
+        if stat.st_size != size:
+            logging.info("Source file changed size: %s" % path)
+            return False
+        if stat.st_mtime != mtime and file_md5(path) != md5:
+            logging.info("Source file changed contents: %s" % path)
+            return False
+    return True
+
+def write_snapshot(data_path, data, filename=None):
+    """Write the given loaded data to a snapshot in data_path
+
+    The header (version and source signatures) and the data are pickled
+    separately, so the header can be checked without loading the data.
+    """
+    if filename is None:
+        filename = os.path.join(data_path, SNAPSHOT_FILENAME)
+
+    header = {'version': SNAPSHOT_VERSION,
+              'sources': source_signatures(data_path)}
+
+    # Write to a temporary file first so readers never see a partial snapshot
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as ofp:
+        pickle.dump(header, ofp, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data, ofp, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, filename)
+    logging.info("Wrote snapshot: %s" % filename)
+
+def read_snapshot(data_path, filename=None):
+    """Return the data stored in the snapshot in data_path, or None
+
+    None is returned if there is no snapshot, it was written by an
+    incompatible version, or the source files have changed since.
+    """
+    if filename is None:
+        filename = os.path.join(data_path, SNAPSHOT_FILENAME)
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename, 'rb') as ifp:
+        try:
+            header = pickle.load(ifp)
+        except (pickle.UnpicklingError, EOFError):
+            logging.warning("Ignoring unreadable snapshot: %s" % filename)
+            return None
+
+        if header.get('version') != SNAPSHOT_VERSION:
+            logging.warning("Ignoring snapshot from another version: %s" % filename)
+            return None
+        if not is_fresh(data_path, header['sources']):
+            logging.warning("Ignoring out of date snapshot: %s" % filename)
+            return None
+
+        logging.info("Loading snapshot: %s" % filename)
+        return pickle.load(ifp)
+
+def read_eligible(data_path):
+    """Return the eligible disease table compiled in data_path, or None
+
+    See generate_patient_pairs.eligible_table
+    """
+    return read_snapshot(data_path, os.path.join(data_path, ELIGIBLE_FILENAME))
+
+def compile_snapshot(data_path, **kwargs):
+    """Parse the data files in data_path and write them to a snapshot"""
+    import generate_patient_pairs as gp
+    data = gp.load_data(data_path, use_snapshot=False)
+    hgmd, omim_dict, orph, hp = data
+    write_snapshot(data_path, gp.eligible_table(hgmd, omim_dict, orph),
+            os.path.join(data_path, ELIGIBLE_FILENAME))
+    write_snapshot(data_path, data)
+
+def check_snapshot(data_path, **kwargs):
+    """Exit with an error if the snapshots in data_path are missing or stale"""
+    for filename in [SNAPSHOT_FILENAME, ELIGIBLE_FILENAME]:
+        filename = os.path.join(data_path, filename)
+        if not os.path.isfile(filename):
+            logging.error("No snapshot: %s" % filename)
+            sys.exit(1)
+
+        with open(filename, 'rb') as ifp:
+            header = pickle.load(ifp)
+        if header.get('version') != SNAPSHOT_VERSION or not is_fresh(data_path, header['sources']):
+            logging.error("Snapshot out of date: %s" % filename)
+            sys.exit(1)
+        logging.info("Snapshot up to date: %s" % filename)
+
+def parse_args(args):
+    parser = ArgumentParser(description=__doc__.strip())
+    subparsers = parser.add_subparsers()
+
+    subparser = subparsers.add_parser('compile', help=compile_snapshot.__doc__)
+    subparser.add_argument('data_path', metavar='DATA',
+            help='Directory from which to grab data files')
+    subparser.set_defaults(function=compile_snapshot)
+
+    subparser = subparsers.add_parser('check', help=check_snapshot.__doc__)
+    subparser.add_argument('data_path', metavar='DATA',
+            help='Directory from which to grab data files')
+    subparser.set_defaults(function=check_snapshot)
+
+    parser.add_argument('--logging', default='INFO',
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            help='Logging level')
+    return parser.parse_args(args)
+
+def main(args = sys.argv[1:]):
+    args = parse_args(args)
+    logging.basicConfig(level=args.logging)
+    args.function(**vars(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
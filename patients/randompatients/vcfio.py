@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Reading and writing of patient VCF files: plain or gzipped input, BGZF
+output (the blocked gzip format indexed by tabix), and a streaming merge
+of inserted variants into a sorted control VCF.
+"""
+
+
+import os
+import sys
+import gzip
+import zlib
+import struct
+import logging
+
+
+__author__ = 'Tal Friedman (talf301@gmail.com)'
+
+# Largest amount of data to put in one BGZF block (as in htslib and Biopython)
+BGZF_BLOCK_SIZE = 65280
+# Empty block marking the end of a BGZF file
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+            '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+# Extension of the sidecar listing inserted records of a sorted patient VCF
+INSERTED_EXT = '.inserted'
+
+def is_vcf(filename):
+    """Return whether filename is a .vcf or .vcf.gz file"""
+    return filename.endswith('.vcf') or filename.endswith('.vcf.gz')
+
+def strip_vcf_ext(filename):
+    """Return filename without its .vcf or .vcf.gz extension"""
+    if filename.endswith('.vcf.gz'):
+        return filename[:-7]
+    assert filename.endswith('.vcf'), filename
+    return filename[:-4]
+
+def open_vcf(filename):
+    """Open a .vcf or .vcf.gz (gzip or BGZF) file for reading"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename)
+
+def bgzf_block(data, level=6):
+    """Return the BGZF block containing data (at most 64KB)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    # Block size - 1, counting the 18 byte header and 8 byte footer
+    bsize = len(cdata) + 25
+    assert bsize < 65536, "BGZF block too large"
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+def append_vcf(filename, lines):
+    """Append lines to a .vcf or .vcf.gz file
+
+    Compressed files are never decompressed: lines are appended to a BGZF
+    file as new blocks (moving the EOF marker after them), and to any other
+    gzip file as a new gzip member.
+    """
+    data = ''.join(lines)
+    if not filename.endswith('.gz'):
+        with open(filename, 'a') as ofp:
+            ofp.write(data)
+        return
+
+    with open(filename, 'r+b') as ofp:
+        ofp.seek(0, os.SEEK_END)
+        if ofp.tell() >= len(BGZF_EOF):
+            ofp.seek(-len(BGZF_EOF), os.SEEK_END)
+            if ofp.read() == BGZF_EOF:
+                # Overwrite the EOF marker, then write it again at the end
+                ofp.seek(-len(BGZF_EOF), os.SEEK_END)
+                for start in range(0, len(data), BGZF_BLOCK_SIZE):
+                    ofp.write(bgzf_block(data[start:start + BGZF_BLOCK_SIZE]))
+                ofp.write(BGZF_EOF)
+                return
+
+        ofp.seek(0, os.SEEK_END)
+        member = gzip.GzipFile(fileobj=ofp, mode='wb')
+        member.write(data)
+        member.close()
+
+class BgzfWriter:
+    """Write a BGZF file, keeping track of virtual offsets
+
+    A virtual offset is (offset of block in file << 16) | offset in block,
+    as used by tabix and in the sidecar of inserted records.
+    """
+    def __init__(self, filename, level=6):
+        self.ofp = open(filename, 'wb')
+        self.level = level
+        self.buffer = []
+        self.buffer_len = 0
+
+    def write(self, data):
+        while data:
+            n = min(len(data), BGZF_BLOCK_SIZE - self.buffer_len)
+            self.buffer.append(data[:n])
+            self.buffer_len += n
+            data = data[n:]
+            if self.buffer_len >= BGZF_BLOCK_SIZE:
+                self.flush()
+
+    def flush(self):
+        """Write out any buffered data as a block"""
+        if self.buffer_len:
+            self.ofp.write(bgzf_block(''.join(self.buffer), self.level))
+            self.buffer = []
+            self.buffer_len = 0
+
+    def tell(self):
+        """Return the virtual offset of the next byte written"""
+        return (self.ofp.tell() << 16) | self.buffer_len
+
+    def close(self):
+        self.flush()
+        self.ofp.write(BGZF_EOF)
+        self.ofp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def record_key(line):
+    """Return the (chromosome, position) of a VCF record line"""
+    tokens = line.split('\t', 2)
+    return tokens[0], int(tokens[1])
+
+def merge_records(lines, records):
+    """Merge inserted records into the lines of a sorted VCF
+
+    Records are placed in coordinate order, taking chromosome order from
+    the control. Records on chromosomes absent from it are put at the end.
+
+    Args:
+        lines: iterable of the lines of the control VCF
+        records: list of newline-terminated VCF record lines to insert
+
+    Yields:
+        (line, inserted?) tuples
+    """
+    # Sorted queue of inserted records for each chromosome
+    pending = {}
+    for record in sorted(records, key=record_key):
+        pending.setdefault(record_key(record)[0], []).append(record)
+
+    cur_chrom = None
+    queue = []
+    for line in lines:
+        if line.startswith('#'):
+            yield line, False
+            continue
+
+        chrom, pos = record_key(line)
+        if chrom != cur_chrom:
+            # Anything left for the last chromosome goes at its end
+            for record in queue:
+                yield record, True
+            cur_chrom = chrom
+            queue = pending.pop(chrom, [])
+
+        while queue and record_key(queue[0])[1] < pos:
+            yield queue.pop(0), True
+        yield line, False
+
+    for record in queue:
+        yield record, True
+    for chrom in sorted(pending):
+        for record in pending[chrom]:
+            yield record, True
+
+def write_sorted_vcf(source, filename, records):
+    """Write the control VCF with records inserted in order as BGZF
+
+    The virtual offset and line of each inserted record are written to
+    a sidecar (filename + INSERTED_EXT), tab-separated, one per line.
+
+    Args:
+        source: path to the sorted control VCF (.vcf or .vcf.gz)
+        filename: path to write the BGZF patient VCF to
+        records: list of newline-terminated VCF record lines to insert
+    """
+    inserted = []
+    with open_vcf(source) as ifp:
+        with BgzfWriter(filename) as ofp:
+            for line, is_inserted in merge_records(ifp, records):
+                if is_inserted:
+                    inserted.append('%d\t%s' % (ofp.tell(), line))
+                ofp.write(line)
+
+    with open(filename + INSERTED_EXT, 'w') as ofp:
+        ofp.writelines(inserted)
+
+def read_inserted(filename):
+    """Return the inserted record lines listed in the sidecar of a sorted VCF"""
+    with open(filename + INSERTED_EXT) as ifp:
+        return [line.split('\t', 1)[1] for line in ifp if line.strip()]